@@ -0,0 +1,94 @@
+'''
+Adaptive forward-pass batch size for generate_embeddings.py --adaptive-batch.
+
+The controller starts from the configured encode batch size and doubles it as long as each step
+up improves throughput (tokens/sec, averaged over a few forward passes) by more than
+GROWTH_THRESHOLD. When a step up doesn't pay off, it goes back to the best size seen and stays
+there. A memory error halves the size, caps it below the size that failed, and the pass is retried,
+so a run that starts too big degrades instead of dying.
+'''
+# Forward passes to average over before judging a batch size
+MEASURE_PASSES = 4
+# A bigger batch has to be at least this much faster to be worth the memory
+GROWTH_THRESHOLD = 0.05
+# What the CUDA and CPU allocators of torch and the ONNX runtime put in their messages. The ONNX
+# runtime's errors don't derive from RuntimeError, and its RuntimeException and Fail are raised for
+# any failure, so every exception is judged by its message alone
+OUT_OF_MEMORY_MESSAGES = ('out of memory', 'failed to allocate', 'not enough memory',
+                          "can't allocate memory", 'cannot allocate memory')
+
+
+def is_out_of_memory(error):
+    """
+    True for the errors torch and the ONNX runtime raise when a batch doesn't fit in memory.
+    """
+    if isinstance(error, MemoryError):
+        return True
+    if type(error).__name__ == 'OutOfMemoryError': # torch.cuda.OutOfMemoryError
+        return True
+    message = str(error).lower()
+    return any(phrase in message for phrase in OUT_OF_MEMORY_MESSAGES)
+
+
+class AdaptiveBatchSize:
+    """
+    Picks the batch size for each forward pass from the throughput of the previous ones.
+    """
+    def __init__(self, initial, maximum):
+        self.size = initial
+        self.maximum = maximum
+        self.settled = False
+        self.best_size = None
+        self.best_rate = 0.0
+        self.backoffs = 0
+        self._tokens = 0
+        self._seconds = 0.0
+        self._passes = 0
+
+    def record(self, num_texts, tokens, seconds):
+        """
+        Records a forward pass of num_texts texts and tokens tokens that took seconds.
+        Passes smaller than the current size (the tail of a batch) aren't representative
+        and are ignored.
+        """
+        if self.settled or num_texts < self.size:
+            return
+        self._tokens += tokens
+        self._seconds += seconds
+        self._passes += 1
+        if self._passes < MEASURE_PASSES:
+            return
+
+        rate = self._tokens / self._seconds if self._seconds > 0 else 0.0
+        self._tokens, self._seconds, self._passes = 0, 0.0, 0
+        if rate > self.best_rate * (1 + GROWTH_THRESHOLD) and self.size * 2 <= self.maximum:
+            self.best_size, self.best_rate = self.size, rate
+            self.size *= 2
+            print(f"Adaptive batch: {self.best_size} -> {self.size} ({rate:,.0f} tokens/s)")
+        else:
+            if rate > self.best_rate:
+                self.best_size, self.best_rate = self.size, rate
+            self.size = self.best_size
+            self.settled = True
+            print(f"Adaptive batch: settled on {self.size} ({self.best_rate:,.0f} tokens/s)")
+
+    def backoff(self):
+        """
+        Halves the batch size after a memory error. Returns False if it can't go any lower.
+        """
+        if self.size <= 1:
+            return False
+        self.backoffs += 1
+        self.maximum = self.size // 2
+        self.size = self.maximum
+        if self.best_size is not None and self.best_size > self.size:
+            self.best_size, self.best_rate = None, 0.0
+        self._tokens, self._seconds, self._passes = 0, 0.0, 0
+        print(f"Adaptive batch: out of memory, backing off to {self.size}")
+        return True
+
+    def summary(self):
+        state = 'steady-state' if self.settled else 'still probing, current'
+        rate = f", {self.best_rate:,.0f} tokens/s" if self.best_rate else ''
+        return (f"Adaptive batch: {state} batch size {self.size}{rate}, "
+                f"{self.backoffs} out-of-memory backoffs (pin it with --encode-batch-size {self.size})")
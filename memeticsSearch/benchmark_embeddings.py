@@ -0,0 +1,300 @@
+'''
+Benchmarks generate_embeddings.py on a synthetic post.csv, so throughput can be compared across
+commits and machines before committing to a big backfill.
+
+The synthetic CSV has the post.csv columns and a tweet-like length distribution: mostly short
+posts, a tail of long-form posts, and the occasional 10k+ character thread (which the embedding
+run truncates). Everything runs offline against a tiny randomly initialized BERT built locally,
+so results measure the pipeline rather than a particular checkpoint; pass --model to time a
+real one instead.
+
+Each combination of --batch-sizes, --workers and --backends runs generate_embeddings.py on the
+same CSV in a fresh process (so peak RSS and warm-up are measured per run), and its stage timing
+report (see stage_timing.py) is appended to a results JSONL file along with the machine it ran
+on. A CSV summary is written next to it.
+
+    python benchmark_embeddings.py --rows 20000 --batch-sizes 64,256,1024 --workers 1,4
+'''
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = 'benchmarks'
+SYNTHETIC_ROWS = 20000
+SEED = 1234
+GENERATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate_embeddings.py')
+
+POST_CSV_COLUMNS = [
+    'tweet_id', 'account_id', 'created_at', 'full_text', 'retweet_count', 'favorite_count',
+    'reply_to_tweet_id', 'reply_to_user_id', 'reply_to_username', 'username', 'archive_upload_id',
+]
+# Share of rows in each length class, and the character range of each. Roughly what the
+# community archive looks like: a few posts with no text, mostly tweets under 280 characters,
+# some long-form posts, and a thin tail of self-reply threads, some past the 10k truncation.
+LENGTH_CLASSES = [
+    ('empty', 0.01, (0, 0)),
+    ('tweet', 0.86, (1, 280)),
+    ('long', 0.11, (281, 4000)),
+    ('thread', 0.02, (4001, 12000)),
+]
+WORDS = (
+    'the a to of and i you it is that in this for on my be just like so me was with what but '
+    'not are have do at your if all they we think about can people one more no get out how '
+    'lol memetics meme vibes based thread twitter post idea really good why when know time '
+    'would thing things because now some there been want make feel much lot yeah actually'
+).split()
+DECORATIONS = ['https://t.co/{}', '@user{}', '#tag{}', '&amp;', '\U0001F602', '\n\n']
+
+
+def synthetic_text(rng, length):
+    """
+    Builds a tweet-like text of about length characters from common words, links and mentions.
+    """
+    parts = []
+    size = 0
+    while size < length:
+        if rng.random() < 0.08:
+            part = DECORATIONS[rng.integers(len(DECORATIONS))].format(rng.integers(1, 10 ** 6))
+        else:
+            part = WORDS[rng.integers(len(WORDS))]
+        parts.append(part)
+        size += len(part) + 1
+    return ' '.join(parts)[:length]
+
+
+def text_length(rng):
+    names, shares, ranges = zip(*LENGTH_CLASSES)
+    low, high = ranges[rng.choice(len(names), p=shares)]
+    if high <= 280:
+        # Short tweets cluster well below the limit
+        return int(np.clip(rng.lognormal(np.log(90), 0.8), low, high))
+    return int(rng.integers(low, high + 1))
+
+
+def generate_csv(path, rows, seed=SEED):
+    """
+    Writes a synthetic post.csv with rows rows. The same seed always gives the same file.
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(POST_CSV_COLUMNS)
+        for i in range(rows):
+            tweet_id = 1_000_000_000_000_000_000 + i * 1000
+            account_id = int(rng.integers(1, 500))
+            is_reply = rng.random() < 0.3
+            created_at = start + datetime.timedelta(seconds=int(i * 3600 + rng.integers(3600)))
+            writer.writerow([
+                tweet_id,
+                account_id,
+                created_at.isoformat(sep=' '),
+                synthetic_text(rng, text_length(rng)),
+                int(rng.zipf(2.0)) - 1,
+                int(rng.zipf(1.7)) - 1,
+                tweet_id - 1000 if is_reply else '',
+                account_id if is_reply else '',
+                f'user{account_id}' if is_reply else '',
+                f'user{account_id}',
+                int(rng.integers(1, 200)),
+            ])
+
+
+def build_tiny_model(path):
+    """
+    Saves a small randomly initialized BERT sentence-transformer to path, built without any
+    downloads. The vocabulary is the synthetic corpus words plus single characters, so
+    tokenization behaves like wordpiece on real text.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel, BertTokenizer
+
+    torch.manual_seed(SEED)
+    bert_dir = os.path.join(path, 'bert')
+    os.makedirs(bert_dir, exist_ok=True)
+    characters = [chr(c) for c in range(33, 127)]
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + characters + ['##' + c for c in characters] + WORDS
+    vocab_path = os.path.join(bert_dir, 'vocab.txt')
+    with open(vocab_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(dict.fromkeys(vocab)) + '\n')
+
+    BertTokenizer(vocab_path).save_pretrained(bert_dir)
+    config = BertConfig(vocab_size=len(dict.fromkeys(vocab)), hidden_size=64, num_hidden_layers=2,
+                        num_attention_heads=2, intermediate_size=128, max_position_embeddings=512)
+    BertModel(config).save_pretrained(bert_dir)
+
+    transformer = models.Transformer(bert_dir, max_seq_length=256)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), 'mean')
+    SentenceTransformer(modules=[transformer, pooling], device='cpu').save(path)
+    print(f"Built tiny benchmark model in {path}")
+
+
+def machine_info():
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['cuda'] = torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+    except ImportError:
+        pass
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                        text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        info['commit'] = None
+    return info
+
+
+def run_config(args, csv_path, batch_size, workers, backend, repeat):
+    """
+    Runs generate_embeddings.py once and returns its timing report, with the run's output
+    sent to a log file. Failures are recorded rather than ending the sweep.
+    """
+    name = f'b{batch_size}-w{workers}-{backend}-r{repeat}'
+    output = os.path.join(args.out_dir, 'runs', name + '.jsonl')
+    stats_path = output + '.stats.json'
+    argv = [
+        sys.executable, GENERATE_SCRIPT,
+        '--input', csv_path,
+        '--output', output,
+        '--model', args.model,
+        '--batch-size', str(batch_size),
+        '--workers', str(workers),
+        '--backend', backend,
+        '--parity-sample', '0',
+        '--stats-interval', '0',
+        '--stats-report', stats_path,
+    ] + args.extra
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    print(f"Running {name}...", end=' ', flush=True)
+    started = time.perf_counter()
+    with open(output + '.log', 'w') as log:
+        returncode = subprocess.run(argv, stdout=log, stderr=subprocess.STDOUT).returncode
+    error = f'exit status {returncode}' if returncode else None
+    wall = time.perf_counter() - started
+
+    result = {'config': name, 'batch_size': batch_size, 'workers': workers, 'backend': backend,
+              'repeat': repeat, 'wall_seconds': wall, 'error': error}
+    if error is None:
+        with open(stats_path, 'r') as f:
+            result['stats'] = json.load(f)
+        print(f"{result['stats']['rows_per_second']:.1f} rows/s")
+    else:
+        print(f"failed ({error}); see {output}.log")
+    if not args.keep_outputs:
+        for path in (output, output + '.checkpoint.json'):
+            if os.path.exists(path):
+                os.remove(path)
+    return result
+
+
+def summary_row(result):
+    row = {key: result[key] for key in ('config', 'batch_size', 'workers', 'backend', 'repeat', 'wall_seconds', 'error')}
+    stats = result.get('stats')
+    if stats:
+        row['rows_per_second'] = round(stats['rows_per_second'], 1)
+        row['tokens_per_second'] = round(stats['tokens_per_second'], 1)
+        # generate_embeddings.py raises --batch-size to feed every worker
+        row['effective_batch_size'] = stats.get('batch_size')
+        # With --workers the model lives in the worker processes
+        peak_rss = max(stats['peak_rss_bytes'] or 0, stats.get('worker_peak_rss_bytes') or 0)
+        row['peak_rss_mb'] = round(peak_rss / 1e6, 1)
+        for stage, timing in stats['stages'].items():
+            row[f'{stage}_seconds'] = round(timing['seconds'], 3)
+    return row
+
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark generate_embeddings.py on synthetic data')
+    parser.add_argument('--rows', type=int, default=SYNTHETIC_ROWS, help='Rows in the synthetic CSV')
+    parser.add_argument('--seed', type=int, default=SEED, help='Seed for the synthetic CSV')
+    parser.add_argument('--input', default=None, help='Benchmark this CSV instead of generating one')
+    parser.add_argument('--model', default=None,
+                        help='Model to benchmark (default: a tiny random BERT built in <out-dir>/tiny-model)')
+    parser.add_argument('--batch-sizes', default='256', help='Comma-separated --batch-size values')
+    parser.add_argument('--workers', default='1', help='Comma-separated --workers values')
+    parser.add_argument('--backends', default='torch', help='Comma-separated --backend values (torch,onnx)')
+    parser.add_argument('--repeats', type=int, default=1, help='Runs per configuration')
+    parser.add_argument('--out-dir', default=BENCHMARK_DIR, help='Where CSVs, runs and results are written')
+    parser.add_argument('--keep-outputs', action='store_true', help='Keep the embedding output of each run')
+    parser.add_argument('extra', nargs=argparse.REMAINDER,
+                        help='Further generate_embeddings.py arguments, after --')
+    args = parser.parse_args(argv)
+    if args.extra and args.extra[0] == '--':
+        args.extra = args.extra[1:]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.out_dir, exist_ok=True)
+    # Never reach out to the Hugging Face hub from a benchmark
+    os.environ.setdefault('HF_HUB_OFFLINE', '1')
+    os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+
+    csv_path = args.input
+    if csv_path is None:
+        csv_path = os.path.join(args.out_dir, f'synthetic-{args.rows}-{args.seed}.csv')
+        if not os.path.exists(csv_path):
+            print(f"Generating {args.rows} synthetic rows in {csv_path}...")
+            generate_csv(csv_path, args.rows, args.seed)
+    if args.model is None:
+        args.model = os.path.join(args.out_dir, 'tiny-model')
+        if not os.path.exists(os.path.join(args.model, 'modules.json')):
+            build_tiny_model(args.model)
+
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    results_path = os.path.join(args.out_dir, f'results-{stamp}.jsonl')
+    info = machine_info()
+    info.update({'input': csv_path, 'input_bytes': os.path.getsize(csv_path), 'model': args.model,
+                 'extra_args': args.extra})
+    print(f"Benchmarking {csv_path} with {args.model}; results in {results_path}")
+
+    summary = []
+    with open(results_path, 'w') as results:
+        for backend in parse_list(args.backends):
+            for workers in parse_list(args.workers, int):
+                for batch_size in parse_list(args.batch_sizes, int):
+                    for repeat in range(args.repeats):
+                        result = run_config(args, csv_path, batch_size, workers, backend, repeat)
+                        result['machine'] = info
+                        results.write(json.dumps(result) + '\n')
+                        results.flush()
+                        summary.append(summary_row(result))
+
+    summary_path = os.path.splitext(results_path)[0] + '.csv'
+    fieldnames = list(dict.fromkeys(key for row in summary for key in row))
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(summary)
+    print(f"Summary saved to {summary_path}")
+    for row in summary:
+        if row['error'] is None:
+            print(f"  {row['config']:<24} {row['rows_per_second']:>10.1f} rows/s "
+                  f"{row['tokens_per_second']:>12.1f} tokens/s {row['peak_rss_mb']:>8.1f} MB peak")
+        else:
+            print(f"  {row['config']:<24} failed: {row['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+'''
+Parquet and Arrow (IPC/Feather) input for generate_embeddings.py, for copies of the archive
+distributed in columnar form.
+
+Only the projected columns are read from the file, in record batches, and every step that the
+CSV reader does per row (skipping empty texts, stripping and truncating them, converting
+values) is done on whole Arrow columns. The rows come out as the same tuples of plain Python
+values the CSV reader produces: created_at as an ISO 8601 string, the counts as ints, and
+everything else, ids included, as strings.
+
+Arrow IPC files are memory-mapped, so reading them costs next to nothing. Resuming skips whole
+Parquet row groups using the file metadata instead of decoding them.
+
+Needs pyarrow: pip install pyarrow. It is only imported once a columnar file is read, so CSV
+runs and --workers children don't pay for it.
+'''
+import os
+
+import numpy as np
+
+COLUMNAR_FORMATS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+
+
+def columnar_format(path):
+    """
+    Returns 'parquet' or 'arrow' for a columnar input path, or None for anything else (CSV).
+    """
+    return COLUMNAR_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def require_pyarrow():
+    """
+    Imports and returns the pyarrow, pyarrow.compute and pyarrow.parquet modules.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading Parquet or Arrow input needs pyarrow: pip install pyarrow")
+    return pa, pc, pq
+
+
+def _open_arrow(path):
+    """
+    Returns the schema and a function yielding the record batches of an Arrow IPC file or
+    stream, memory-mapped.
+    """
+    pa, _, _ = require_pyarrow()
+    source = pa.memory_map(path)
+    try:
+        reader = pa.ipc.open_file(source)
+        return reader.schema, lambda: (reader.get_batch(i) for i in range(reader.num_record_batches))
+    except pa.ArrowInvalid:
+        reader = pa.ipc.open_stream(pa.memory_map(path))
+        return reader.schema, lambda: iter(reader)
+
+
+def schema_names(path, fmt):
+    _, _, pq = require_pyarrow()
+    if fmt == 'parquet':
+        return pq.ParquetFile(path).schema_arrow.names
+    schema, _ = _open_arrow(path)
+    return schema.names
+
+
+def iter_record_batches(path, fmt, columns, batch_size, skip_rows=0):
+    """
+    Yields record batches of at most batch_size rows holding only columns, starting skip_rows
+    rows into the file.
+    """
+    _, _, pq = require_pyarrow()
+    if fmt == 'parquet':
+        parquet = pq.ParquetFile(path)
+        row_groups = []
+        for i in range(parquet.num_row_groups):
+            group_rows = parquet.metadata.row_group(i).num_rows
+            if not row_groups and skip_rows >= group_rows:
+                skip_rows -= group_rows
+                continue
+            row_groups.append(i)
+        if not row_groups:
+            return
+        batches = parquet.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns)
+    else:
+        _, read = _open_arrow(path)
+        batches = (batch.select(columns) for batch in read())
+
+    for record_batch in batches:
+        if skip_rows >= record_batch.num_rows:
+            skip_rows -= record_batch.num_rows
+            continue
+        if skip_rows:
+            record_batch = record_batch.slice(skip_rows)
+            skip_rows = 0
+        # IPC files can hold batches of any size
+        for start in range(0, record_batch.num_rows, batch_size):
+            yield record_batch.slice(start, batch_size)
+
+
+def column_to_python(array, parse=None):
+    """
+    Converts an Arrow column to the values the CSV reader would produce for it: parse is the
+    function the CSV reader applies to the column's strings, if any.
+    """
+    pa, pc, _ = require_pyarrow()
+    if pa.types.is_timestamp(array.type) or pa.types.is_date(array.type):
+        return [None if value is None else value.isoformat() for value in array.to_pylist()]
+    if parse is not None and pa.types.is_integer(array.type):
+        return array.to_pylist()
+    values = pc.fill_null(array.cast(pa.string()), '').to_pylist()
+    if parse is not None:
+        return [parse(value) for value in values]
+    return values
+
+
+def convert_batch(record_batch, columns, text_column, max_text_length, parsers=None):
+    """
+    Returns (rows, texts, positions) for the rows of record_batch that have text: the rows as
+    tuples of columns, the stripped text to embed for each, and their positions in the batch.
+    As in the CSV reader, a text over max_text_length characters is truncated in the output too.
+    """
+    pa, pc, _ = require_pyarrow()
+    parsers = parsers or {}
+    text = record_batch.column(text_column).cast(pa.string())
+    stripped = pc.utf8_trim_whitespace(text)
+    lengths = pc.fill_null(pc.utf8_length(stripped), 0)
+    positions = np.flatnonzero(pc.greater(lengths, 0).to_numpy(zero_copy_only=False))
+    if len(positions) == 0:
+        return [], [], positions
+
+    too_long = pc.greater(lengths, max_text_length)
+    truncated = pc.utf8_slice_codeunits(stripped, 0, max_text_length)
+    texts = pc.if_else(too_long, truncated, stripped).take(positions).to_pylist()
+
+    values = []
+    for column in columns:
+        if column == text_column:
+            values.append(pc.if_else(too_long, truncated, text).take(positions).to_pylist())
+        else:
+            values.append(column_to_python(record_batch.column(column).take(positions), parsers.get(column)))
+    return list(zip(*values)), texts, positions
@@ -0,0 +1,134 @@
+'''
+The set of tweet_ids that already have embeddings, used by generate_embeddings.py --incremental
+to embed only new tweets into a delta output.
+
+The ids are kept as a sorted int64 .npy array (8 bytes per tweet, so ~100 MB for the whole
+archive) and looked up a batch at a time with np.searchsorted. A JSON file next to it lists the
+deltas written so far. While a delta is being written, its ids are appended to a .pending file
+in step with the checkpoint; they are only merged into the set once the delta is complete, so a
+crashed run can be resumed or thrown away without corrupting the set.
+'''
+import json
+import os
+
+import numpy as np
+
+
+def parse_ids(values):
+    """
+    Converts tweet_id strings to int64, using -1 for anything that isn't an integer.
+    """
+    try:
+        return np.array(values, dtype=np.int64)
+    except (ValueError, TypeError):
+        ids = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            try:
+                ids[i] = int(value)
+            except (ValueError, TypeError):
+                ids[i] = -1
+        return ids
+
+
+class EmbeddedIds:
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = os.path.splitext(path)[0] + '.json'
+        self.pending_path = path + '.pending'
+        self.pending_file = None
+
+        if os.path.exists(path):
+            self.ids = np.load(path)
+        else:
+            self.ids = np.empty(0, dtype=np.int64)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'deltas': [], 'pending': None}
+
+    @property
+    def watermark(self):
+        """
+        The highest tweet_id embedded so far, or None if there are none.
+        """
+        return int(self.ids[-1]) if len(self.ids) else None
+
+    def next_delta_path(self, output):
+        """
+        posts_with_vectors.jsonl -> posts_with_vectors-delta-00004.jsonl
+        """
+        root, ext = os.path.splitext(output)
+        return f'{root}-delta-{len(self.meta["deltas"]) + 1:05d}{ext}'
+
+    def seen_mask(self, ids):
+        """
+        Returns a boolean array that is True where ids are already in the set.
+        """
+        if len(self.ids) == 0:
+            return np.zeros(len(ids), dtype=bool)
+        positions = np.searchsorted(self.ids, ids)
+        positions[positions == len(self.ids)] = 0
+        return self.ids[positions] == ids
+
+    def begin_delta(self, output, resume_count=None):
+        """
+        Starts recording the ids written to output. When resuming, the pending ids are cut back
+        to the resume_count rows the checkpoint says were written.
+        """
+        if resume_count is not None and os.path.exists(self.pending_path):
+            os.truncate(self.pending_path, resume_count * 8)
+            self.pending_file = open(self.pending_path, 'ab')
+        else:
+            if self.meta['pending'] is not None and self.meta['pending']['output'] != output:
+                print(f"Warning: discarding the unfinished delta {self.meta['pending']['output']}")
+            self.pending_file = open(self.pending_path, 'wb')
+        self.meta['pending'] = {'output': output}
+        self._save_meta()
+
+    def add(self, ids):
+        self.pending_file.write(np.asarray(ids, dtype=np.int64).tobytes())
+        self.pending_file.flush()
+
+    def commit(self):
+        """
+        Merges the pending ids into the set once the delta output is complete. Returns the
+        number of ids added, or None if the delta has no rows, in which case it isn't listed
+        and the caller should remove its output.
+        """
+        self.pending_file.close()
+        self.pending_file = None
+        pending = np.fromfile(self.pending_path, dtype=np.int64)
+        if len(pending) == 0:
+            self.meta['pending'] = None
+            self._save_meta()
+            os.remove(self.pending_path)
+            return None
+        pending = pending[pending >= 0]
+        before = len(self.ids)
+        self.ids = np.union1d(self.ids, pending)
+
+        tmp_path = self.path + '.tmp.npy'
+        np.save(tmp_path, self.ids)
+        os.replace(tmp_path, self.path)
+        self.meta['deltas'].append({
+            'output': self.meta['pending']['output'],
+            'rows': int(len(pending)),
+            'new_ids': int(len(self.ids) - before),
+            'watermark': self.watermark,
+        })
+        self.meta['pending'] = None
+        self._save_meta()
+        os.remove(self.pending_path)
+        return len(self.ids) - before
+
+    def close(self):
+        if self.pending_file is not None:
+            self.pending_file.close()
+            self.pending_file = None
+
+    def _save_meta(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
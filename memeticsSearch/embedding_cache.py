@@ -0,0 +1,154 @@
+'''
+A persistent, content-addressed cache of sentence embeddings, used by generate_embeddings.py to
+avoid re-encoding texts it has already seen (retweet copies, "lol", bare URLs, copypasta...).
+
+Entries live in a SQLite database keyed by a hash of the model name and the normalized text, so
+the same file can be shared between models without mixing up their vectors. The name passed in
+includes the backend and quantization for anything but the torch model (see cache_identity in
+generate_embeddings.py), so ONNX vectors never stand in for torch ones. Once the stored
+vectors grow past the configured size, the least recently used entries are evicted.
+'''
+import hashlib
+import sqlite3
+
+import numpy as np
+
+# When the cache is over its size limit, evict down to this fraction of it so we don't end
+# up evicting a handful of entries after every single batch.
+EVICTION_TARGET = 0.9
+
+
+def normalize_for_cache(text):
+    """
+    Collapses whitespace so trivially different copies of a text share a cache entry.
+    """
+    return ' '.join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Looks up embeddings by (model name, normalized text) and only sends misses to the model.
+    """
+    def __init__(self, path, model_name, max_bytes):
+        self.path = path
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' key BLOB PRIMARY KEY,'
+            ' vector BLOB NOT NULL,'
+            ' last_used INTEGER NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.conn.commit()
+
+        # Run statistics
+        self.lookups = 0
+        self.hits = 0
+        self.bytes_saved = 0 # UTF-8 bytes of text that didn't have to go through the model
+        self.evicted = 0
+
+        self.stored_bytes, self.clock = self.conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(vector)), 0), COALESCE(MAX(last_used), 0) FROM embeddings'
+        ).fetchone()
+        # The limit may have been lowered since the cache was last used
+        if self.stored_bytes > self.max_bytes:
+            self._evict()
+            self.conn.commit()
+
+    def key(self, text):
+        data = self.model_name.encode('utf-8') + b'\0' + normalize_for_cache(text).encode('utf-8')
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def encode(self, texts, encode_fn):
+        """
+        Returns a float32 array of embeddings for texts. Texts found in the cache are served
+        from it, repeated texts within the batch are encoded once, and the remaining unique
+        texts are passed to encode_fn in a single call and then stored.
+        """
+        keys = [self.key(text) for text in texts]
+        self.clock += 1
+        found = self._fetch(set(keys))
+
+        # First occurrence of each key that has to be encoded
+        miss_positions = {}
+        for i, key in enumerate(keys):
+            if key not in found and key not in miss_positions:
+                miss_positions[key] = i
+
+        self.lookups += len(texts)
+        self.hits += len(texts) - len(miss_positions)
+        self.bytes_saved += sum(len(text.encode('utf-8')) for text in texts)
+        self.bytes_saved -= sum(len(texts[i].encode('utf-8')) for i in miss_positions.values())
+
+        if miss_positions:
+            miss_texts = [texts[i] for i in miss_positions.values()]
+            miss_embeddings = np.asarray(encode_fn(miss_texts), dtype=np.float32)
+            for key, vector in zip(miss_positions, miss_embeddings):
+                found[key] = vector
+            self._store(zip(miss_positions, miss_embeddings))
+
+        return np.stack([found[key] for key in keys])
+
+    def _fetch(self, keys):
+        found = {}
+        keys = list(keys)
+        # Stay well below SQLite's limit on the number of bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+            if rows:
+                self.conn.execute(
+                    f'UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})',
+                    [self.clock] + chunk
+                )
+        return found
+
+    def _store(self, items):
+        rows = [(key, vector.tobytes(), self.clock) for key, vector in items]
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)', rows
+        )
+        self.stored_bytes += sum(len(vector) for _, vector, _ in rows)
+        if self.stored_bytes > self.max_bytes:
+            self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        """
+        Deletes least recently used entries until the cache is back under EVICTION_TARGET.
+        """
+        target = self.max_bytes * EVICTION_TARGET
+        while self.stored_bytes > target:
+            rows = self.conn.execute(
+                'SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000'
+            ).fetchall()
+            if not rows:
+                self.stored_bytes = 0
+                break
+            victims = []
+            for key, size in rows:
+                victims.append((key,))
+                self.stored_bytes -= size
+                if self.stored_bytes <= target:
+                    break
+            self.conn.executemany('DELETE FROM embeddings WHERE key = ?', victims)
+            self.evicted += len(victims)
+
+    def summary(self):
+        hit_rate = self.hits / self.lookups if self.lookups else 0.0
+        return (f"Cache: {self.hits} hits of {self.lookups} lookups ({hit_rate:.1%}), "
+                f"{self.bytes_saved / 1e6:.1f} MB of text not re-encoded, "
+                f"{self.evicted} entries evicted, {self.stored_bytes / 1e6:.1f} MB stored")
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
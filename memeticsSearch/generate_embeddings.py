@@ -1,113 +1,753 @@
 '''
-This script reads tweet data from a CSV file, generates sentence embeddings for the tweet text
-using a GPU-accelerated model, and saves the output to a JSONL file for later ingestion.
+This script reads tweet data from a CSV (or Parquet/Arrow) file, generates sentence embeddings
+for the tweet text, and saves the output to a JSONL or .npy file, or an OpenSearch index, for
+later search.
+
+Batches are read, encoded and written in turn, with a checkpoint after each so a crashed run can
+be resumed. The flags for caching, batching, CPU workers, output formats, incremental runs and
+memory limits are listed by --help and described in readme.md; the helper modules next to this
+script hold the details.
 '''
+import argparse
+import contextlib
 import csv
-from sentence_transformers import SentenceTransformer
-import torch
+import datetime
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import json
 
+from embedded_ids import EmbeddedIds, parse_ids
+from batch_sizing import AdaptiveBatchSize, is_out_of_memory
+from columnar_input import columnar_format, convert_batch, iter_record_batches, schema_names
+from embedding_cache import EmbeddingCache
+from long_text import POOLING_METHODS, TextChunker
+from memory_budget import MemoryBudget
+from model_cache import configure_model_cache, resolve_model
+from near_duplicates import (BANDS, DEDUP_CAPACITY, DEDUP_THRESHOLD, NUM_PERMUTATIONS, SIGNATURE_BYTES,
+                             NearDuplicateIndex)
+from opensearch_sink import BULK_CONCURRENCY, BULK_SIZE, OPENSEARCH_URL, OpenSearchWriter
+from parallel_csv import PREFETCH_PER_WORKER, RANGE_BYTES, OffsetLineReader, ParallelCSVReader, read_header
+from stage_timing import StageTimer, peak_rss_bytes, timed
+from text_normalization import TextNormalizer
+from vector_compression import (PROJECTION_SUFFIX, QUANTIZATION_SUFFIX, PcaProjection, ScalarQuantizer, recall_at_k,
+                                reduce_precision)
+from vector_writers import JsonlWriter, NpyWriter, ShardedWriter
+
 # --- Configuration ---
 INPUT_CSV_PATH = 'post.csv'
 OUTPUT_JSONL_PATH = 'posts_with_vectors.jsonl'
+OUTPUT_NPY_PATH = 'posts_vectors.npy'
+# With --output-format opensearch nothing is written locally but the checkpoint and the timing
+# report, which are named after this
+OUTPUT_OPENSEARCH_PATH = 'posts_opensearch'
+OPENSEARCH_INDEX = 'posts'
 MODEL_NAME = 'all-MiniLM-L6-v2' # A good starting model
 TEXT_COLUMN = 'full_text' # The column containing the text to embed
+ID_COLUMN = 'tweet_id'
+# Column --dedup adds to the output: the tweet_id of the first tweet of the row's group
+DUP_GROUP_COLUMN = 'dup_group_id'
+# The fields of the `posts` index mapping in ingest_jsonl.ts. Anything else in the CSV is
+# dropped at parse time unless --columns asks for it.
+POSTS_COLUMNS = [
+    'tweet_id', 'account_id', 'created_at', 'full_text', 'retweet_count', 'favorite_count',
+    'reply_to_tweet_id', 'reply_to_user_id', 'reply_to_username', 'username',
+]
 # Adjust based on your GPU's VRAM and the nature of your data.
 # Larger batches are faster but use more memory.
-BATCH_SIZE = 256 
+BATCH_SIZE = 256
+# Longer texts are truncated. With --chunk-long-texts every token is embedded, so the cap only
+# guards against pathological rows.
+MAX_TEXT_LENGTH = 10000
+CHUNKED_MAX_TEXT_LENGTH = 100000
+# Tokens shared by consecutive windows of a chunked text, so a sentence cut at a window
+# boundary is still seen whole by one of them
+CHUNK_OVERLAP = 32
+# Texts per forward pass inside a batch. --adaptive-batch starts here and tunes it, up to the
+# rows in a batch.
+ENCODE_BATCH_SIZE = 32
+# Batches buffered between stages in --pipeline mode. Two or three is enough to keep the
+# model busy; more just holds extra rows in memory.
+PIPELINE_QUEUE_SIZE = 4
+# The checkpoint is written next to the output unless --checkpoint says otherwise
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+# Likewise the per-stage timing report, and how often a [stats] progress line is printed
+STATS_SUFFIX = '.stats.json'
+STATS_INTERVAL = 30
+# Upper bound on the vectors kept in the --cache database. At 384 float32 dimensions this is
+# roughly 1.3M distinct texts.
+CACHE_MAX_MB = 2048
+# Padded tokens per forward pass in --bucket-window mode. 32 texts at the model's 256 token
+# limit is what the unbucketed path can already put through in one sub-batch.
+BUCKET_TOKEN_BUDGET = 32 * 256
+BUCKET_MAX_BATCH_SIZE = 512
+CHARS_PER_TOKEN = 4 # Rough average for English tweets with the MiniLM wordpiece vocabulary
+# Texts per task handed to a --workers process when not bucketing. Small enough to balance the
+# load across workers, large enough that pickling overhead stays negligible.
+WORKER_CHUNK_SIZE = 64
+# Texts from the start of the input used to compare the ONNX backend against torch
+PARITY_SAMPLE_SIZE = 256
+# Texts from the start of the input encoded up front to fit int8 quantization and to measure
+# the recall of reduced-precision vectors. The first RECALL_QUERIES of them are held out as
+# queries; the rest are the corpus searched.
+CALIBRATION_SAMPLE_SIZE = 5000
+RECALL_QUERIES = 200
+RECALL_K = 10
+# Sample vectors added to the --reduce-dim covariance at a time
+PCA_FIT_CHUNK = 1000
+# Rough size of the rows parsed from a byte of CSV, for what --read-workers read ahead under
+# --max-memory-mb
+PARSED_BYTES_PER_CSV_BYTE = 3
+# Transient memory per vector value while a batch is formatted as JSON (a Python float, its text
+# and the encoder's pieces; measured), which one batch at a time needs on top of those in flight
+JSON_BYTES_PER_VALUE = 160
+
+
+class Batch:
+    """
+    A run of CSV rows that travels through the encode and write stages together. Rows are
+    tuples of values for the projected columns; texts holds the text to embed for each row.
+    """
+    def __init__(self, columns, rows, texts, row_numbers, rows_read, end_offset):
+        self.columns = columns
+        self.rows = rows
+        self.texts = texts
+        self.row_numbers = row_numbers # 1-based CSV row number of each row
+        self.rows_read = rows_read # CSV rows consumed up to and including this batch
+        self.end_offset = end_offset # Byte offset in the CSV just past this batch's last row
+        self.embeddings = None # One array per model
+        self.chunks = None # With --chunk-long-texts, how the texts were split into chunks
+        self.chunk_embeddings = None # And the vectors of those chunks, for --chunk-output
+
+
+class ModelRun:
+    """
+    One of the models of a run, with everything kept per model: its output and writer, its
+    cache, the calibrated projection and quantizer, the chunker and the forward-pass sizer.
+    """
+    def __init__(self, name, path, model, output):
+        self.name = name
+        self.path = path # What the model was loaded from
+        self.model = model
+        self.output = output
+        self.projection = None
+        self.quantizer = None
+        self.cache = None
+        self.chunker = None
+        self.sizer = None
+        self.writer = None
+
+    @property
+    def dim(self):
+        if self.projection is not None:
+            return self.projection.dim
+        return self.model.get_sentence_embedding_dimension()
+
+
+def cache_identity(model_name, backend, onnx_quantization):
+    """
+    The model identity --cache entries are keyed by. The ONNX export is quantized and its
+    vectors differ slightly from the torch model's, so each backend and quantization gets its
+    own entries; torch keeps the bare model name, so existing caches stay valid.
+    """
+    if backend == 'torch':
+        return model_name
+    return f"{model_name}@{backend}-{onnx_quantization}"
+
+
+def model_output_path(path, model_name):
+    """
+    Returns the output path for one of several models: path with the model's name (the last
+    part of it, for a path or an organization/name) before the extension.
+    """
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{os.path.basename(model_name.rstrip('/'))}{extension}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generate sentence embeddings for tweets in a CSV file.')
+    parser.add_argument('--input', default=INPUT_CSV_PATH,
+                        help='CSV file to read, or a Parquet (.parquet) or Arrow IPC (.arrow, .feather) file')
+    parser.add_argument('--output', default=None,
+                        help=f'File to write (default: {OUTPUT_JSONL_PATH}, or {OUTPUT_NPY_PATH} for npy output)')
+    parser.add_argument('--output-format', choices=['jsonl', 'npy', 'opensearch'], default='jsonl',
+                        help='jsonl inlines vectors in each record; npy writes a .npy matrix plus a metadata sidecar; '
+                             'opensearch indexes the records directly through the bulk API')
+    parser.add_argument('--vector-dtype', choices=['float32', 'float16', 'int8'], default='float32',
+                        help='Precision of the output vectors (int8 is per-dimension scalar quantized, npy only)')
+    parser.add_argument('--json-decimals', type=int, default=None,
+                        help='Write JSONL vectors as fixed-point numbers with this many decimals (at least 1, e.g. 6), '
+                             'formatted in bulk; by default floats are written exactly')
+    parser.add_argument('--opensearch-url', default=os.environ.get('OPENSEARCH_URL', OPENSEARCH_URL),
+                        help='OpenSearch node for --output-format opensearch (default: $OPENSEARCH_URL or %(default)s)')
+    parser.add_argument('--opensearch-index', default=OPENSEARCH_INDEX,
+                        help='Index to write to, created with the posts mapping if missing')
+    parser.add_argument('--bulk-size', type=int, default=BULK_SIZE, help='Documents per OpenSearch bulk request')
+    parser.add_argument('--bulk-concurrency', type=int, default=BULK_CONCURRENCY,
+                        help='OpenSearch bulk requests in flight at once')
+    parser.add_argument('--shard-size', type=int, default=None,
+                        help='Roll the output over into a new numbered shard every this many rows')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Deal batches round-robin across this many numbered shards')
+    parser.add_argument('--incremental', default=None, metavar='IDS_PATH',
+                        help='Skip tweet_ids recorded in this .npy file and write only new tweets to a delta output')
+    parser.add_argument('--reduce-dim', type=int, default=None,
+                        help='Project the vectors onto this many principal components (e.g. 128), fit on the calibration sample')
+    parser.add_argument('--projection', default=None,
+                        help=f'Where the --reduce-dim projection is saved, or loaded from if it exists '
+                             f'(default: <output>{PROJECTION_SUFFIX}, reused when resuming, or with --incremental '
+                             f'<ids>{PROJECTION_SUFFIX}, shared by every delta)')
+    parser.add_argument('--calibration-sample', type=int, default=CALIBRATION_SAMPLE_SIZE,
+                        help='Texts encoded up front to fit int8 quantization and report recall (0 skips the report)')
+    parser.add_argument('--metadata-columns', default=None,
+                        help='Comma-separated columns for the npy metadata sidecar (default: all)')
+    parser.add_argument('--model', default=MODEL_NAME,
+                        help='SentenceTransformer model name or path, or several comma-separated ones '
+                             'encoded in the same pass, each to its own output')
+    parser.add_argument('--model-cache', default=None,
+                        help='Directory to download the model to and load it from (default: the Hugging Face cache)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Load the model from the cache without any network access')
+    parser.add_argument('--text-column', default=TEXT_COLUMN, help='Column containing the text to embed')
+    parser.add_argument('--columns', default=','.join(POSTS_COLUMNS),
+                        help="Comma-separated columns to keep in the output, or 'all' "
+                             "(default: the fields of the posts index mapping)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Rows per batch')
+    parser.add_argument('--normalize-text', action='store_true',
+                        help='Strip URLs, leading @mentions and HTML entities from the text before encoding')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Encode one tweet per group of near-duplicates and reuse its vector for the rest')
+    parser.add_argument('--dedup-threshold', type=float, default=DEDUP_THRESHOLD,
+                        help='Estimated Jaccard similarity of character shingles at which tweets count as copies')
+    parser.add_argument('--dedup-capacity', type=int, default=DEDUP_CAPACITY,
+                        help='Most recent near-duplicate groups remembered, with their vectors')
+    parser.add_argument('--chunk-long-texts', action='store_true',
+                        help='Embed texts longer than the model window as pooled overlapping chunks instead of truncating')
+    parser.add_argument('--chunk-overlap', type=int, default=CHUNK_OVERLAP,
+                        help='Tokens shared by consecutive chunks')
+    parser.add_argument('--chunk-pooling', choices=POOLING_METHODS, default='mean',
+                        help="Average chunk vectors equally, or 'weighted' by their token counts")
+    parser.add_argument('--chunk-output', default=None,
+                        help='Also write the vector of every chunk of a chunked text to this JSONL file')
+    parser.add_argument('--encode-batch-size', type=int, default=ENCODE_BATCH_SIZE,
+                        help='Texts per forward pass of the model')
+    parser.add_argument('--adaptive-batch', action='store_true',
+                        help='Tune the forward pass size for throughput, and back off instead of failing on out-of-memory errors')
+    parser.add_argument('--read-workers', type=int, default=1,
+                        help='Processes parsing the CSV in parallel byte ranges')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run parsing, encoding and writing as separate stages')
+    parser.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+                        help='Batches buffered between stages in --pipeline mode')
+    parser.add_argument('--max-memory-mb', type=int, default=None,
+                        help='Resident memory ceiling; the reader pauses while buffered batches would exceed it')
+    parser.add_argument('--checkpoint', default=None,
+                        help=f'Checkpoint file (default: <output>{CHECKPOINT_SUFFIX})')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the checkpoint, appending to the existing output')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='Seconds between [stats] progress lines (0 to disable)')
+    parser.add_argument('--stats-report', default=None,
+                        help=f'Where to save the JSON timing report (default: <output>{STATS_SUFFIX})')
+    parser.add_argument('--cache', default=None,
+                        help='SQLite file caching embeddings by model and text (disabled by default)')
+    parser.add_argument('--cache-max-mb', type=int, default=CACHE_MAX_MB,
+                        help='Evict least recently used cache entries beyond this size')
+    parser.add_argument('--bucket-window', type=int, default=0,
+                        help='Buffer this many rows and encode them in length-sorted buckets (e.g. 50000)')
+    parser.add_argument('--bucket-token-budget', type=int, default=BUCKET_TOKEN_BUDGET,
+                        help='Padded tokens per forward pass when bucketing')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='CPU encoding processes, each with its own copy of the model')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='Torch intra-op threads per worker (default: cores / workers)')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help='Run the model with PyTorch or with a quantized ONNX export on the CPU')
+    parser.add_argument('--onnx-quantization', choices=['avx2', 'avx512', 'avx512_vnni', 'arm64', 'none'],
+                        default='avx2', help='Instruction set the int8 ONNX model is quantized for')
+    parser.add_argument('--parity-sample', type=int, default=PARITY_SAMPLE_SIZE,
+                        help='Texts to compare between the ONNX and torch models before the run (0 to skip)')
+    args = parser.parse_args(argv)
+    if args.vector_dtype == 'int8' and args.output_format != 'npy':
+        parser.error('--vector-dtype int8 needs --output-format npy')
+    if args.vector_dtype == 'int8' and args.calibration_sample <= RECALL_QUERIES:
+        parser.error(f'--vector-dtype int8 needs a --calibration-sample larger than {RECALL_QUERIES}')
+    if args.max_memory_mb is not None and args.max_memory_mb <= 0:
+        parser.error('--max-memory-mb must be positive')
+    if args.json_decimals is not None and args.json_decimals < 1:
+        # Fixed-point formatting with no decimals leaves a bare '1.', which isn't valid JSON
+        parser.error('--json-decimals must be at least 1')
+    if args.reduce_dim is not None and args.reduce_dim <= 0:
+        parser.error('--reduce-dim must be positive')
+    if args.projection and not args.reduce_dim:
+        parser.error('--projection needs --reduce-dim')
+    if args.shard_size is not None and args.shards is not None:
+        parser.error('--shard-size and --shards are mutually exclusive')
+    if args.output_format == 'opensearch' and (args.shard_size or args.shards):
+        parser.error('--output-format opensearch does not combine with --shard-size or --shards')
+    if args.adaptive_batch and (args.bucket_window or args.workers > 1):
+        parser.error('--adaptive-batch does not combine with --bucket-window or --workers')
+    if args.chunk_output and not args.chunk_long_texts:
+        parser.error('--chunk-output needs --chunk-long-texts')
+    if args.chunk_output and args.dedup:
+        parser.error('--chunk-output does not combine with --dedup')
+    if not 0 < args.dedup_threshold <= 1:
+        parser.error('--dedup-threshold must be between 0 and 1')
+    if args.read_workers > 1 and columnar_format(args.input):
+        parser.error('--read-workers only applies to CSV input')
+    if (args.incremental or args.dedup or args.output_format == 'opensearch') and args.columns != 'all' \
+            and ID_COLUMN not in args.columns.split(','):
+        parser.error(f'--incremental, --dedup and --output-format opensearch need {ID_COLUMN} in --columns')
+    args.models = args.model.split(',')
+    if len(set(os.path.basename(name.rstrip('/')) for name in args.models)) != len(args.models):
+        parser.error('--model names must differ, since they name the outputs')
+    if len(args.models) > 1:
+        if args.workers > 1 or args.backend == 'onnx':
+            parser.error('Several models need the default torch backend without --workers')
+        if args.output_format == 'opensearch':
+            parser.error('Several models do not combine with --output-format opensearch')
+        if args.chunk_output or args.projection:
+            parser.error('Several models do not combine with --chunk-output or --projection')
+    if args.incremental is None:
+        resolve_output_paths(args)
+    return args
+
+
+def resolve_output_paths(args, embedded=None):
+    """
+    Fills in the default output and checkpoint paths. In incremental mode the default output
+    is the next numbered delta, or the unfinished one when resuming.
+    """
+    if args.output is None:
+        args.output = {
+            'npy': OUTPUT_NPY_PATH,
+            'opensearch': OUTPUT_OPENSEARCH_PATH,
+        }.get(args.output_format, OUTPUT_JSONL_PATH)
+        if embedded is not None:
+            pending = embedded.meta['pending']
+            if args.resume and pending is not None:
+                args.output = pending['output']
+            else:
+                args.output = embedded.next_delta_path(args.output)
+    if args.checkpoint is None:
+        args.checkpoint = args.output + CHECKPOINT_SUFFIX
+    if args.stats_report is None:
+        args.stats_report = args.output + STATS_SUFFIX
+
+
+def load_checkpoint(path):
+    """
+    Returns the checkpoint stored at path, or None if there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    Writes the checkpoint atomically, so a crash mid-write leaves the previous one intact.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
 
 # --- Main Execution ---
-def main():
+def main(argv=None):
+    args = parse_args(argv)
+    # Before anything imports sentence_transformers, which reads these settings at import time
+    configure_model_cache(args.model_cache, args.offline)
+    # The ONNX export is cached by model name, so it is left to resolve the name itself
+    model_paths = [resolve_model(name, args.model_cache, args.offline) if args.backend == 'torch' else name
+                   for name in args.models]
+    embedded = None
+    if args.incremental:
+        embedded = EmbeddedIds(args.incremental)
+        resolve_output_paths(args, embedded)
     print(f"Starting embedding generation...")
-    print(f"Input CSV: {INPUT_CSV_PATH}")
-    print(f"Output JSONL: {OUTPUT_JSONL_PATH}")
-    print(f"Model: {MODEL_NAME}")
-    print(f"Text column: {TEXT_COLUMN}")
-    print(f"Batch size: {BATCH_SIZE}")
-    
-    # 1. Check for GPU availability
-    if torch.cuda.is_available():
-        device = 'cuda'
-        print(f"GPU found: {torch.cuda.get_device_name(0)}. Using GPU.")
-        print(f"GPU memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB")
+    input_format = columnar_format(args.input)
+    print(f"Input: {args.input} ({input_format or 'csv'})")
+    if args.output_format == 'opensearch':
+        print(f"Output: index {args.opensearch_index} ({args.vector_dtype} vectors), "
+              f"{args.bulk_size} documents per bulk request, {args.bulk_concurrency} in flight")
+    elif len(args.models) == 1:
+        print(f"Output: {args.output} ({args.output_format}, {args.vector_dtype} vectors)")
     else:
-        device = 'cpu'
-        print("No GPU found. Using CPU. This will be much slower.")
+        print(f"Outputs: {', '.join(model_output_path(args.output, name) for name in args.models)} "
+              f"({args.output_format}, {args.vector_dtype} vectors)")
+    if args.shard_size:
+        print(f"Sharding: a new shard every {args.shard_size} rows")
+    elif args.shards:
+        print(f"Sharding: {args.shards} shards, filled round-robin")
+    print(f"Model{'s' if len(args.models) > 1 else ''}: {', '.join(args.models)} ({args.backend} backend)")
+    for name, model_path in zip(args.models, model_paths):
+        if model_path != name:
+            print(f"Model files: {model_path} (offline)")
+    print(f"Text column: {args.text_column}")
+    print(f"Columns: {args.columns}")
+    print(f"Batch size: {args.batch_size}")
+    if args.normalize_text:
+        print("Text normalization: on")
+    if args.dedup:
+        print(f"Near-duplicates: encoded once at a similarity of {args.dedup_threshold}, "
+              f"the last {args.dedup_capacity} groups remembered")
+    if args.chunk_long_texts:
+        print(f"Long texts: chunked with {args.chunk_overlap} tokens of overlap, {args.chunk_pooling} pooling"
+              f"{f', chunks written to {args.chunk_output}' if args.chunk_output else ''}")
+    print(f"Encode batch size: {args.encode_batch_size}{' (adaptive)' if args.adaptive_batch else ''}")
+    if args.bucket_window:
+        print(f"Length bucketing: windows of {args.bucket_window} rows, {args.bucket_token_budget} tokens per forward pass")
+    print(f"Mode: {'pipelined' if args.pipeline else 'sequential'}")
+    if args.max_memory_mb:
+        print(f"Memory ceiling: {args.max_memory_mb} MB")
+    if args.workers > 1:
+        print(f"Workers: {args.workers}")
+    if args.read_workers > 1:
+        print(f"CSV reader processes: {args.read_workers}")
+    print(f"Checkpoint: {args.checkpoint}")
+    print(f"Cache: {args.cache or 'disabled'}")
+    if embedded is not None:
+        print(f"Incremental: {len(embedded.ids)} tweet_ids already embedded (watermark {embedded.watermark}), "
+              f"{len(embedded.meta['deltas'])} earlier deltas")
 
-    # 2. Load the pre-trained model
-    print(f"Loading model '{MODEL_NAME}'...")
-    try:
-        model = SentenceTransformer(MODEL_NAME, device=device)
-        print("Model loaded successfully.")
-        print(f"Model max sequence length: {model.max_seq_length}")
-        print(f"Model embedding dimension: {model.get_sentence_embedding_dimension()}")
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        raise
+    checkpoint = None
+    if args.resume:
+        checkpoint = load_checkpoint(args.checkpoint)
+        if checkpoint is None:
+            print(f"Warning: --resume given but no checkpoint at {args.checkpoint}, starting from the beginning")
+        else:
+            if checkpoint['input_path'] != args.input:
+                print(f"Warning: checkpoint was written for {checkpoint['input_path']}, not {args.input}")
+            if len(args.models) > 1 and sorted(checkpoint.get('models', {})) != sorted(args.models):
+                raise RuntimeError(f"Checkpoint was written for the models {sorted(checkpoint.get('models', {}))}, "
+                                   f"not {sorted(args.models)}; cannot resume")
+            if len(args.models) == 1 and 'models' in checkpoint:
+                raise RuntimeError("Checkpoint was written for several models; cannot resume with one")
+            # With several models, each has its own writer state
+            writer_state = checkpoint['models'][args.models[0]] if len(args.models) > 1 else checkpoint
+            if ('shards' in writer_state) != bool(args.shard_size or args.shards):
+                raise RuntimeError("Checkpoint and arguments disagree on whether the output is sharded; cannot resume")
+            if checkpoint.get('output_format', 'jsonl') != args.output_format:
+                raise RuntimeError(f"Checkpoint was written for {checkpoint.get('output_format', 'jsonl')} "
+                                   f"output, not {args.output_format}; cannot resume")
+            if checkpoint.get('input_format', 'csv') != (input_format or 'csv'):
+                raise RuntimeError(f"Checkpoint was written for {checkpoint.get('input_format', 'csv')} "
+                                   f"input, not {input_format or 'csv'}; cannot resume")
+            position = f"byte {checkpoint['input_offset']}" if input_format is None else 'columnar input'
+            print(f"Resuming after row {checkpoint['rows_read']} ({position}), "
+                  f"{checkpoint['records_written']} records already written")
+
+    # Fail on a bad input before any time goes into the model
+    check_input(args.input, input_format, args.text_column, checkpoint['fieldnames'] if checkpoint else None)
 
-    # 3. Process CSV in chunks and write to JSONL
-    print(f"Processing {INPUT_CSV_PATH} in batches and writing to {OUTPUT_JSONL_PATH}...")
-    
+    # 1-2. Pick the device and load the models on a thread, while the input is opened and the
+    # first batch parsed
+    started = time.perf_counter()
+    loader = ThreadPoolExecutor(max_workers=1)
+    loading = loader.submit(prepare_model, args, model_paths)
+    loader.shutdown(wait=False)
+
+    # The clock restarts once the model is ready, so loading and calibration don't count
+    # against the stages
+    timer = StageTimer(args.stats_interval)
+    runs = []
+    budget = None
+    pool = None
+    chunk_writer = None
+    succeeded = False
     try:
-        with open(INPUT_CSV_PATH, 'r', encoding='utf-8') as csvfile, \
-             open(OUTPUT_JSONL_PATH, 'w') as jsonlfile:
-            
-            reader = csv.DictReader(csvfile)
-            batch = []
-            total_rows = 0
-            processed_rows = 0
-
-            for row in reader:
-                total_rows += 1
-                
-                # Debug first few rows
-                if total_rows <= 3:
-                    print(f"Row {total_rows}: {dict(row)}")
-                
-                # Only process rows that have content in the text column
-                text_content = row.get(TEXT_COLUMN, '').strip()
-                if text_content:
-                    # Validate text length
-                    if len(text_content) > 10000:  # Arbitrary long text threshold
-                        print(f"Warning: Very long text in row {total_rows} ({len(text_content)} chars), truncating...")
-                        row[TEXT_COLUMN] = text_content[:10000]
-                    batch.append(row)
+        # Columnar files are opened by pyarrow, by path
+        with contextlib.nullcontext() if input_format else open(args.input, 'rb') as csvfile:
+
+            counts = {'total_rows': 0, 'processed_rows': 0}
+            fieldnames = None
+            if checkpoint is not None:
+                if csvfile is not None:
+                    csvfile.seek(checkpoint['input_offset'])
+                fieldnames = checkpoint['fieldnames']
+                counts['total_rows'] = checkpoint['rows_read']
+                counts['processed_rows'] = checkpoint['records_written']
+            batch_size = args.bucket_window or args.batch_size
+            if args.workers > 1 and batch_size < args.workers * WORKER_CHUNK_SIZE:
+                # Give every worker at least one full chunk per batch
+                batch_size = args.workers * WORKER_CHUNK_SIZE
+                print(f"Raising batch size to {batch_size} so all {args.workers} workers are kept busy")
+            token_budget = args.bucket_token_budget if args.bucket_window else None
+            columns = None if args.columns == 'all' else args.columns.split(',')
+            max_text_length = CHUNKED_MAX_TEXT_LENGTH if args.chunk_long_texts else MAX_TEXT_LENGTH
+            if input_format is not None:
+                batches = read_columnar_batches(args.input, input_format, args.text_column, batch_size, counts,
+                                                columns, timer, max_text_length,
+                                                checkpoint['input_offset'] if checkpoint is not None else 0)
+            else:
+                batches = read_batches(csvfile, args.text_column, batch_size, counts, fieldnames, columns, timer,
+                                       max_text_length, args.read_workers)
+            if embedded is not None:
+                embedded.begin_delta(args.output, checkpoint['records_written'] if checkpoint else None)
+                counts['skipped_rows'] = 0
+                batches = skip_embedded(batches, embedded, counts)
+            first_batch = next(batches, None)
+            if not loading.done():
+                print(f"First batch read in {time.perf_counter() - started:.1f}s; waiting for the model...")
+            device, models = loading.result()
+            model_load_seconds = time.perf_counter() - started
+            if first_batch is not None:
+                batches = itertools.chain([first_batch], batches)
+            for name, model_path, model in zip(args.models, model_paths, models):
+                output = args.output if len(args.models) == 1 else model_output_path(args.output, name)
+                runs.append(ModelRun(name, model_path, model, output))
+
+            if args.backend == 'onnx' and args.parity_sample > 0:
+                from onnx_backend import parity_check
+                texts = sample_texts(args.input, args.text_column, args.parity_sample)
+                print(f"Checking ONNX parity against torch on {len(texts)} texts...")
+                max_deviation, mean_deviation = parity_check(runs[0].model, runs[0].path, texts, device)
+                print(f"ONNX parity: max cosine deviation {max_deviation:.2e}, mean {mean_deviation:.2e}")
+
+            for run in runs:
+                if args.vector_dtype != 'float32' or args.reduce_dim:
+                    projection_path = args.projection
+                    if projection_path is None and args.incremental:
+                        # Every delta has to share one basis, or their vectors can't share an index
+                        projection_path = args.incremental + PROJECTION_SUFFIX
+                        if len(runs) > 1:
+                            projection_path = model_output_path(projection_path, run.name)
+                    run.projection, run.quantizer = calibrate_vectors(args, run.model, device, run.output,
+                                                                      checkpoint is not None, projection_path)
+                if args.cache:
+                    # Each model gets its own database, so each keeps to --cache-max-mb
+                    cache_path = args.cache if len(runs) == 1 else model_output_path(args.cache, run.name)
+                    run.cache = EmbeddingCache(cache_path, cache_identity(run.name, args.backend, args.onnx_quantization),
+                                               args.cache_max_mb * 1024 * 1024)
+                    print(f"Opened embedding cache {cache_path} with {run.cache.stored_bytes / 1e6:.1f} MB of vectors")
+                if args.adaptive_batch:
+                    # A forward pass can't be bigger than the batch it comes from
+                    run.sizer = AdaptiveBatchSize(min(args.encode_batch_size, batch_size), batch_size)
+                timer.instrument_model(run.model)
+
+            if args.workers > 1:
+                threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+                print(f"Starting {args.workers} encoding workers with {threads} threads each...")
+                pool = EncoderPool(runs[0].path, args.backend, args.onnx_quantization, args.workers, threads)
+                # The workers load their models once started, which mustn't be timed as encoding
+                pool.wait_ready()
+
+            timer.restart_clock()
+
+            # 3. Process CSV in chunks and write the output
+            destination = f"index {args.opensearch_index}" if args.output_format == 'opensearch' else \
+                ', '.join(run.output for run in runs)
+            print(f"Processing {args.input} in batches and writing to {destination}...")
+
+            normalizer = TextNormalizer(getattr(runs[0].model, 'tokenizer', None)) if args.normalize_text else None
+            deduplicator = None
+            if args.dedup:
+                # Every text of a batch has to fit, since their groups are only stored once it's encoded
+                deduplicator = NearDuplicateIndex(args.dedup_threshold, max(args.dedup_capacity, batch_size))
+            for run in runs:
+                if args.chunk_long_texts:
+                    # Leave room for the [CLS] and [SEP] tokens the model adds to every chunk
+                    run.chunker = TextChunker(run.model.tokenizer, run.model.max_seq_length - 2, args.chunk_overlap,
+                                              args.chunk_pooling)
+                # Resuming drops anything written after the last checkpoint, including partial lines
+                resume_state = checkpoint
+                if checkpoint is not None and len(runs) > 1:
+                    resume_state = checkpoint['models'][run.name]
+                run.writer = open_writer(args, run.dim, resume_state, run.quantizer, timer, run.output, run.name)
+            if args.chunk_output:
+                chunk_state = checkpoint.get('chunk_output') if checkpoint is not None else None
+                if checkpoint is not None and chunk_state is None:
+                    raise RuntimeError("Checkpoint has no --chunk-output position; cannot resume with --chunk-output")
+                chunk_writer = JsonlWriter(args.chunk_output, runs[0].dim, chunk_state,
+                                           args.vector_dtype, args.json_decimals, timer)
+
+            def embed(run, batch, texts):
+                """
+                Returns the vectors of texts, the ones to encode from batch, by run's model.
+                """
+                model, chunker, projection = run.model, run.chunker, run.projection
+                if not texts:
+                    # Every text was a copy of one encoded earlier
+                    embeddings = np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+                elif chunker is None:
+                    embeddings = encode_texts(texts, model, device, run.cache, token_budget, pool,
+                                              args.encode_batch_size, run.sizer, timer)
                 else:
-                    if total_rows <= 10:  # Log first few missing texts
-                        print(f"Warning: No text content in row {total_rows}")
-                
-                if len(batch) >= BATCH_SIZE:
-                    try:
-                        process_batch(batch, model, jsonlfile, TEXT_COLUMN, device)
-                        processed_rows += len(batch)
-                        print(f"Processed {processed_rows} of {total_rows} rows...")
-                        batch = []
-                    except Exception as e:
-                        print(f"Error processing batch at row {total_rows}: {e}")
-                        print(f"Batch size: {len(batch)}")
-                        # Log problematic batch data
-                        for i, problematic_row in enumerate(batch):
-                            text_len = len(problematic_row.get(TEXT_COLUMN, ''))
-                            print(f"  Batch item {i}: text length {text_len}")
-                        raise
-
-            # Process the final batch
-            if batch:
+                    batch.chunks = chunker.split(texts)
+                    batch.chunk_embeddings = encode_texts(batch.chunks.texts, model, device, run.cache, token_budget,
+                                                          pool, args.encode_batch_size, run.sizer, timer)
+                    embeddings = chunker.pool(batch.chunks, batch.chunk_embeddings)
+                if projection is not None:
+                    with timer.stage('project'):
+                        embeddings = projection.project(embeddings)
+                        if chunk_writer is not None:
+                            batch.chunk_embeddings = projection.project(batch.chunk_embeddings)
+                return embeddings
+
+            def encode(batch):
+                if not batch.rows:
+                    return
                 try:
-                    process_batch(batch, model, jsonlfile, TEXT_COLUMN, device)
-                    processed_rows += len(batch)
-                    print(f"Processed final batch: {len(batch)} rows")
+                    texts = batch.texts
+                    if normalizer is not None:
+                        with timer.stage('normalize'):
+                            texts = normalizer.normalize(texts)
+                    plan = None
+                    if deduplicator is not None:
+                        with timer.stage('dedup'):
+                            if ID_COLUMN not in batch.columns:
+                                raise ValueError(f"--dedup needs the '{ID_COLUMN}' column in the output")
+                            id_index = batch.columns.index(ID_COLUMN)
+                            plan = deduplicator.assign(texts, [row[id_index] for row in batch.rows])
+                            texts = [texts[i] for i in plan.encode_positions]
+                    batch.embeddings = [embed(run, batch, texts) for run in runs]
+                    if plan is not None:
+                        with timer.stage('dedup'):
+                            batch.embeddings = [deduplicator.expand(plan, embeddings, run.name)
+                                                for run, embeddings in zip(runs, batch.embeddings)]
+                            batch.columns = tuple(batch.columns) + (DUP_GROUP_COLUMN,)
+                            batch.rows = [row + (group_id,) for row, group_id in zip(batch.rows, plan.group_ids)]
                 except Exception as e:
-                    print(f"Error processing final batch: {e}")
+                    log_failed_batch(batch, e)
                     raise
 
+            def write(batch):
+                if batch.rows:
+                    for run, embeddings in zip(runs, batch.embeddings):
+                        run.writer.write(batch.rows, embeddings, batch.row_numbers, batch.columns)
+                    if chunk_writer is not None:
+                        write_chunks(chunk_writer, batch)
+                    if embedded is not None:
+                        embedded.add(batch.ids)
+                counts['processed_rows'] += len(batch.rows)
+                timer.count(rows=len(batch.rows))
+                with timer.stage('disk_write'):
+                    states = {run.name: run.writer.state() for run in runs}
+                    state = states[runs[0].name] if len(runs) == 1 else {'models': states}
+                    # The OpenSearch writer only lets the run checkpoint every few bulk requests
+                    if None not in states.values():
+                        if chunk_writer is not None:
+                            state['chunk_output'] = chunk_writer.state()
+                        save_checkpoint(args.checkpoint, {
+                            'input_path': args.input,
+                            'output_path': args.output,
+                            'output_format': args.output_format,
+                            'input_format': input_format or 'csv',
+                            'fieldnames': counts['fieldnames'],
+                            'input_offset': batch.end_offset,
+                            'rows_read': batch.rows_read,
+                            'records_written': counts['processed_rows'],
+                            **state,
+                        })
+                print(f"Processed {counts['processed_rows']} of {batch.rows_read} rows...")
+                timer.maybe_report()
+
+            if args.max_memory_mb:
+                # Every row gets a float32 vector from each model before it's projected
+                budget = MemoryBudget(args.max_memory_mb * 1024 * 1024,
+                                      sum(4 * run.model.get_sentence_embedding_dimension() for run in runs))
+                reserved = 0
+                if deduplicator is not None:
+                    # Allocated up front, but only takes up memory as it fills
+                    reserved += deduplicator.capacity * (4 * NUM_PERMUTATIONS + 100 * BANDS +
+                                                         sum(4 * run.dim for run in runs)) + SIGNATURE_BYTES
+                if args.output_format != 'npy':
+                    reserved += batch_size * sum(run.dim for run in runs) * JSON_BYTES_PER_VALUE
+                if args.read_workers > 1 and input_format is None:
+                    reserved += args.read_workers * PREFETCH_PER_WORKER * RANGE_BYTES * PARSED_BYTES_PER_CSV_BYTE
+                budget.start(reserved)
+                print(f"Memory budget for batches in flight: {budget.budget / (1024 * 1024):.0f} MB")
+
+            if args.pipeline:
+                run_pipelined(batches, encode, write, args.queue_size, budget)
+            else:
+                run_sequential(batches, encode, write, budget)
+
+        for run in runs:
+            run.writer.close()
+        if chunk_writer is not None:
+            chunk_writer.close()
+        delta_written = True
+        if embedded is not None:
+            new_ids = embedded.commit()
+            if new_ids is None:
+                # Nothing new since the last run: leave no empty delta for loaders to iterate over
+                delta_written = False
+                for run in runs:
+                    for path in getattr(run.writer, 'paths', []):
+                        os.remove(path)
+                if os.path.exists(args.checkpoint):
+                    os.remove(args.checkpoint)
+        succeeded = True
         print("\nProcessing complete.")
-        print(f"Total rows read: {total_rows}")
-        print(f"Rows with text processed: {processed_rows}")
-        print(f"Output saved to {OUTPUT_JSONL_PATH}")
+        print(f"Total rows read: {counts['total_rows']}")
+        print(f"Rows with text processed: {counts['processed_rows']}")
+        if embedded is not None:
+            print(f"Rows skipped as already embedded: {counts['skipped_rows']}")
+            if delta_written:
+                print(f"Added {new_ids} tweet_ids to {args.incremental} (now {len(embedded.ids)}, watermark {embedded.watermark})")
+            else:
+                print(f"No new tweet_ids; no delta written (still {len(embedded.ids)}, watermark {embedded.watermark})")
+        for run in runs:
+            if len(runs) > 1:
+                print(f"{run.name}:")
+            writer = run.writer
+            if isinstance(writer, OpenSearchWriter):
+                print(writer.summary())
+            elif delta_written:
+                print(f"Output saved to {run.output}")
+                if isinstance(writer, ShardedWriter):
+                    print(f"Shard manifest saved to {writer.manifest_path}")
+                elif args.output_format == 'npy':
+                    print(f"Metadata saved to {writer.metadata_path}; load the vectors with np.load('{run.output}', mmap_mode='r')")
+            if run.cache is not None:
+                print(run.cache.summary())
+            if run.sizer is not None:
+                print(run.sizer.summary())
+            if run.chunker is not None:
+                print(run.chunker.summary())
+        if pool is not None:
+            for line in pool.summary():
+                print(line)
+        if normalizer is not None:
+            print(normalizer.summary())
+        if deduplicator is not None:
+            print(deduplicator.summary())
+        if budget is not None:
+            print(budget.summary())
+        print(timer.progress_line())
+        # Named after the delta by default, and the next run reuses an unwritten delta's number
+        if delta_written:
+            timer.save(args.stats_report, {
+                'input': args.input,
+                'output': args.output,
+                'model': args.model,
+                'backend': args.backend,
+                'device': device,
+                'batch_size': batch_size,
+                'encode_batch_size': runs[0].sizer.size if args.adaptive_batch else args.encode_batch_size,
+                'outputs': {run.name: run.output for run in runs} if len(runs) > 1 else None,
+                'workers': args.workers,
+                'pipeline': args.pipeline,
+                'model_load_seconds': model_load_seconds,
+                'reduce_dim': args.reduce_dim,
+                'normalization': normalizer.stats() if normalizer is not None else None,
+                'dedup': deduplicator.stats() if deduplicator is not None else None,
+                'memory': budget.stats() if budget is not None else None,
+            })
+            print(f"Timing report saved to {args.stats_report}")
 
     except FileNotFoundError as e:
-        print(f"Error: Input file not found at {INPUT_CSV_PATH}")
+        print(f"Error: Input file not found at {args.input}")
         print(f"FileNotFoundError details: {e}")
         raise
     except Exception as e:
@@ -117,53 +757,806 @@ def main():
         print(f"Full traceback:")
         traceback.print_exc()
         raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for run in runs:
+            if run.writer is not None and not succeeded:
+                run.writer.abort()
+        if chunk_writer is not None and not succeeded:
+            chunk_writer.abort()
+        if embedded is not None:
+            embedded.close()
+        for run in runs:
+            if run.cache is not None:
+                run.cache.close()
+
+
+def check_input(path, input_format, text_column, fieldnames=None):
+    """
+    Reads the header (or schema) of the input and raises if it has no text_column, so a wrong
+    path or column fails at once instead of after the model has loaded. When resuming, pass
+    the checkpoint's fieldnames instead.
+    """
+    if fieldnames is None:
+        fieldnames = schema_names(path, input_format) if input_format is not None else read_header(path)[0]
+    # An empty CSV is not an error, there is just nothing to do
+    if fieldnames is not None and text_column not in fieldnames:
+        raise ValueError(f"Text column '{text_column}' is not in the input header: {fieldnames}")
+
+
+def prepare_model(args, model_paths):
+    """
+    Picks the device and loads the models. Runs on a thread while main() starts reading the
+    input, which is also why torch is only imported here.
+    """
+    import torch
+
+    # 1. Check for GPU availability
+    if args.workers > 1 or args.backend == 'onnx':
+        device = 'cpu'
+        print(f"Using the CPU ({args.workers} worker processes).")
+        if torch.cuda.is_available():
+            print("Warning: a GPU is available but --workers and --backend onnx encode on the CPU.")
+    elif torch.cuda.is_available():
+        device = 'cuda'
+        print(f"GPU found: {torch.cuda.get_device_name(0)}. Using GPU.")
+        print(f"GPU memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB")
+    else:
+        device = 'cpu'
+        print("No GPU found. Using CPU. This will be much slower.")
+
+    # 2. Load the pre-trained models
+    models = []
+    for name, model_path in zip(args.models, model_paths):
+        print(f"Loading model '{name}'...")
+        started = time.perf_counter()
+        try:
+            model = load_model(model_path, args.backend, device, args.onnx_quantization)
+            print(f"Model loaded successfully in {time.perf_counter() - started:.1f}s.")
+            print(f"Model max sequence length: {model.max_seq_length}")
+            print(f"Model embedding dimension: {model.get_sentence_embedding_dimension()}")
+        except Exception as e:
+            print(f"Error loading model: {e}")
+            raise
+        models.append(model)
+    return device, models
+
+
+def load_model(model_name, backend, device, onnx_quantization='avx2', threads=None):
+    """
+    Loads model_name with the requested backend. Both return a SentenceTransformer, so
+    callers only ever use model.encode().
+    """
+    if backend == 'onnx':
+        from onnx_backend import load_onnx_model
+        return load_onnx_model(model_name, onnx_quantization, threads)
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device=device)
+
+
+def sample_texts(path, text_column, count):
+    """
+    Returns up to count non-empty texts from the start of the input, truncated like the main loop
+    (without --chunk-long-texts).
+    """
+    texts = []
+    input_format = columnar_format(path)
+    if input_format is not None:
+        for record_batch in iter_record_batches(path, input_format, [text_column], max(count, 1)):
+            texts += convert_batch(record_batch, [], text_column, MAX_TEXT_LENGTH)[1]
+            if len(texts) >= count:
+                break
+        return texts[:count]
+    with open(path, 'r', encoding='utf-8', newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            text = row.get(text_column, '').strip()
+            if text:
+                texts.append(text[:MAX_TEXT_LENGTH])
+                if len(texts) >= count:
+                    break
+    return texts
+
+
+def calibrate_vectors(args, model, device, output, resuming=False, projection_path=None):
+    """
+    Encodes a sample of the input to fit the --reduce-dim projection and then the int8
+    quantizer, on the projected vectors. Both are reloaded instead when resuming, so the whole
+    output shares one set of parameters, and so is a shared projection_path (--projection, or
+    the one next to the --incremental ids) that already exists.
+    Reports recall@k of the stored vectors against the full float32 ones on held-out queries,
+    which are projected but keep full precision, as they would at search time. The parameters
+    are saved next to output. Returns the projection and the quantizer, either of which may be
+    None.
+    """
+    projection = None
+    shared = projection_path is not None
+    projection_path = projection_path or output + PROJECTION_SUFFIX
+    if args.reduce_dim and (resuming or shared) and os.path.exists(projection_path):
+        print(f"Reusing the PCA projection from {projection_path}")
+        projection = PcaProjection.load(projection_path)
+        if projection.dim != args.reduce_dim:
+            raise RuntimeError(f"{projection_path} projects to {projection.dim} dimensions, not {args.reduce_dim}")
+    quantizer = None
+    quantization_path = output + QUANTIZATION_SUFFIX
+    if args.vector_dtype == 'int8' and resuming:
+        print(f"Reusing quantization parameters from {quantization_path}")
+        quantizer = ScalarQuantizer.load(quantization_path)
+    missing = [name for name, needed in [('the PCA projection', args.reduce_dim and projection is None),
+                                         ('int8 quantization', args.vector_dtype == 'int8' and quantizer is None)]
+               if needed]
+    if args.calibration_sample <= 0:
+        if missing:
+            raise RuntimeError(f"Fitting {' and '.join(missing)} needs a --calibration-sample")
+        return projection, quantizer
+
+    texts = sample_texts(args.input, args.text_column, args.calibration_sample)
+    if len(texts) <= RECALL_QUERIES:
+        if missing:
+            raise RuntimeError(f"Need more than {RECALL_QUERIES} texts to fit {' and '.join(missing)}, "
+                               f"found {len(texts)} in {args.input}")
+        print(f"Skipping the recall report: only {len(texts)} texts in {args.input}")
+        return projection, quantizer
+
+    print(f"Encoding {len(texts)} sample texts to calibrate the stored vectors...")
+    vectors = np.asarray(model.encode(texts, show_progress_bar=False, device=device, batch_size=32),
+                         dtype=np.float32)
+    queries, corpus = vectors[:RECALL_QUERIES], vectors[RECALL_QUERIES:]
+    stored_queries, stored = queries, corpus
+    if args.reduce_dim:
+        if projection is None:
+            chunks = (corpus[start:start + PCA_FIT_CHUNK] for start in range(0, len(corpus), PCA_FIT_CHUNK))
+            projection = PcaProjection.fit(chunks, args.reduce_dim)
+            projection.save(projection_path)
+            print(f"Fit a {projection.dim}-dimension PCA projection on {len(corpus)} vectors, keeping "
+                  f"{projection.explained_variance:.1%} of the variance; saved to {projection_path}")
+        stored_queries, stored = projection.project(queries), projection.project(corpus)
+    if args.vector_dtype == 'int8' and quantizer is None:
+        quantizer = ScalarQuantizer.fit(stored)
+
+    recall = recall_at_k(queries, corpus, stored_queries, reduce_precision(stored, args.vector_dtype, quantizer),
+                         RECALL_K)
+    stored_as = f"{args.reduce_dim}-dimension {args.vector_dtype}" if args.reduce_dim else args.vector_dtype
+    print(f"{stored_as} recall@{RECALL_K} vs {vectors.shape[1]}-dimension float32: {recall:.4f} "
+          f"({len(queries)} held-out queries over {len(corpus)} vectors)")
+    return projection, quantizer
+
+
+def open_writer(args, dim, checkpoint=None, quantizer=None, timer=None, output=None, model_name=None):
+    """
+    Creates the writer for args.output_format writing to output (default args.output), sharded
+    if requested, resuming from the checkpoint if there is one. A timer records its
+    serialization and write times.
+    """
+    output = output or args.output
+    metadata_columns = args.metadata_columns.split(',') if args.metadata_columns else None
+
+    if args.output_format == 'opensearch':
+        return OpenSearchWriter(args.opensearch_url, args.opensearch_index, dim, ID_COLUMN, checkpoint,
+                                args.vector_dtype, args.json_decimals, args.bulk_size, args.bulk_concurrency, timer)
+
+    sharded = bool(args.shard_size or args.shards)
+
+    def open_file(path, resume_state):
+        if args.output_format == 'npy':
+            # Shards share the quantizer the ShardedWriter saves once
+            return NpyWriter(path, dim, resume_state, args.vector_dtype, metadata_columns, quantizer, timer,
+                             save_quantizer=not sharded)
+        return JsonlWriter(path, dim, resume_state, args.vector_dtype, args.json_decimals, timer)
+
+    if sharded:
+        manifest_info = {
+            'input': args.input,
+            'model': model_name or args.model,
+            'format': args.output_format,
+            'vector_dtype': args.vector_dtype,
+            'dim': dim,
+        }
+        return ShardedWriter(output, open_file, args.shard_size, args.shards, checkpoint,
+                             ID_COLUMN, manifest_info, quantizer)
+    return open_file(output, checkpoint)
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_date(value):
+    """
+    Converts post.csv timestamps like '2023-01-02 03:04:05+00:00' to ISO 8601.
+    """
+    try:
+        return datetime.datetime.fromisoformat(value).isoformat()
+    except (ValueError, TypeError):
+        return None
+
+
+# Columns converted from strings at parse time; everything else is kept as text
+COLUMN_PARSERS = {
+    'created_at': parse_date,
+    'retweet_count': parse_int,
+    'favorite_count': parse_int,
+}
+
+
+def project_columns(fieldnames, columns, text_column):
+    """
+    Returns the columns (all fieldnames if None) that the input has, as a tuple, warning
+    about the ones it doesn't.
+    """
+    if columns is None:
+        columns = list(fieldnames)
+    missing = [column for column in columns if column not in fieldnames]
+    if missing:
+        print(f"Warning: columns not in the input and left out of the output: {', '.join(missing)}")
+    if text_column not in fieldnames:
+        raise ValueError(f"Text column '{text_column}' is not in the input header: {fieldnames}")
+    return tuple(column for column in columns if column in fieldnames)
+
+
+def read_batches(csvfile, text_column, batch_size, counts, fieldnames=None, columns=None, timer=None,
+                 max_text_length=MAX_TEXT_LENGTH, read_workers=1):
+    """
+    Reads rows from the CSV file (opened in binary mode) and yields them as Batch objects of
+    up to batch_size rows. Rows without text are skipped; counts['total_rows'] tracks every row
+    read. When resuming mid-file, pass the header's fieldnames since it won't be read again.
+
+    Texts longer than max_text_length characters are truncated, in the output as well. Each
+    row is kept as a tuple of the given columns (all of them if None), with the values of
+    COLUMN_PARSERS columns converted as they are read. A timer gets the time spent parsing the
+    CSV and validating and projecting rows, excluding the time the consumer holds each batch.
+
+    With read_workers > 1, the rest of the file is parsed by a ParallelCSVReader, which only
+    sends back the fields that are needed.
+    """
+    lines = OffsetLineReader(csvfile)
+    reader = csv.reader(lines)
+    if fieldnames is None:
+        fieldnames = next(reader, None)
+        if fieldnames is None:
+            return
+    counts['fieldnames'] = fieldnames
+
+    columns = project_columns(fieldnames, columns, text_column)
+
+    reader_pool = None
+    if read_workers > 1:
+        layout = [column for column in fieldnames if column in columns or column == text_column]
+        reader_pool = ParallelCSVReader(csvfile.name, read_workers, start=lines.offset, columns=layout)
+        records = reader_pool.records()
+    else:
+        layout = fieldnames
+        records = ((values, lines.offset) for values in reader)
+    text_index = layout.index(text_column)
+    projection = [(layout.index(column), COLUMN_PARSERS.get(column)) for column in columns]
+
+    batch = []
+    texts = []
+    row_numbers = []
+    clock = time.perf_counter
+    parse_seconds = validate_seconds = 0.0
+    offset = lines.offset
+
+    try:
+        mark = clock()
+        for values, offset in records:
+            parsed = clock()
+            parse_seconds += parsed - mark
+            counts['total_rows'] += 1
+            total_rows = counts['total_rows']
+            if len(values) < len(layout):
+                values += [''] * (len(layout) - len(values))
+
+            # Debug first few rows
+            if total_rows <= 3:
+                print(f"Row {total_rows}: {dict(zip(layout, values))}")
+
+            # Only process rows that have content in the text column
+            text_content = values[text_index].strip()
+            if text_content:
+                # Validate text length
+                if len(text_content) > max_text_length:
+                    print(f"Warning: Very long text in row {total_rows} ({len(text_content)} chars), truncating...")
+                    text_content = text_content[:max_text_length]
+                    values[text_index] = text_content
+                batch.append(tuple(
+                    parse(values[index]) if parse else values[index]
+                    for index, parse in projection
+                ))
+                texts.append(text_content)
+                row_numbers.append(total_rows)
+            else:
+                if total_rows <= 10:  # Log first few missing texts
+                    print(f"Warning: No text content in row {total_rows}")
+
+            mark = clock()
+            validate_seconds += mark - parsed
+            if len(batch) >= batch_size:
+                if timer is not None:
+                    timer.add('csv_parse', parse_seconds)
+                    timer.add('validate', validate_seconds)
+                    parse_seconds = validate_seconds = 0.0
+                yield Batch(columns, batch, texts, row_numbers, total_rows, offset)
+                batch = []
+                texts = []
+                row_numbers = []
+                mark = clock()
+
+        if timer is not None:
+            timer.add('csv_parse', parse_seconds + clock() - mark)
+            timer.add('validate', validate_seconds)
+        # The final, partial batch
+        if batch:
+            yield Batch(columns, batch, texts, row_numbers, counts['total_rows'], offset)
+    finally:
+        if reader_pool is not None:
+            reader_pool.close()
+
+
+def read_columnar_batches(path, input_format, text_column, batch_size, counts, columns=None, timer=None,
+                          max_text_length=MAX_TEXT_LENGTH, skip_rows=0):
+    """
+    Reads rows from a Parquet or Arrow file (see columnar_input.py) and yields them as Batch
+    objects like read_batches does, except that end_offset counts rows rather than bytes.
+    Only the columns that are needed are read, skipping the first skip_rows rows. A timer
+    gets the time spent reading record batches as CSV parsing and the time spent converting
+    them as validation.
+    """
+    fieldnames = schema_names(path, input_format)
+    counts['fieldnames'] = fieldnames
+    columns = project_columns(fieldnames, columns, text_column)
+    layout = [column for column in fieldnames if column in columns or column == text_column]
+    parsers = {column: COLUMN_PARSERS[column] for column in columns if column in COLUMN_PARSERS}
+    record_batches = iter_record_batches(path, input_format, layout, batch_size, skip_rows)
+
+    while True:
+        with timed(timer, 'csv_parse'):
+            record_batch = next(record_batches, None)
+        if record_batch is None:
+            return
+        with timed(timer, 'validate'):
+            first_row = counts['total_rows'] + 1
+            rows, texts, positions = convert_batch(record_batch, columns, text_column, max_text_length, parsers)
+            row_numbers = (positions + first_row).tolist()
+            counts['total_rows'] += record_batch.num_rows
+
+        # Debug first few rows
+        for row_number, row in zip(row_numbers, rows):
+            if row_number > 3:
+                break
+            print(f"Row {row_number}: {dict(zip(columns, row))}")
+        if rows:
+            yield Batch(columns, rows, texts, row_numbers, counts['total_rows'], counts['total_rows'])
+
+
+# Columns of the --chunk-output records, besides the vector
+CHUNK_COLUMNS = ('row', ID_COLUMN, 'chunk', 'start', 'end', 'tokens')
+
+
+def write_chunks(chunk_writer, batch):
+    """
+    Writes the vectors of every chunk of the texts in batch that were split into chunks.
+    """
+    chunks = batch.chunks
+    chunked = set(chunks.chunked_texts().tolist())
+    if not chunked:
+        return
+    id_index = batch.columns.index(ID_COLUMN) if ID_COLUMN in batch.columns else None
+    positions = [i for i, owner in enumerate(chunks.owners) if owner in chunked]
+    rows = []
+    for i in positions:
+        owner = chunks.owners[i]
+        start, end = chunks.spans[i]
+        tweet_id = batch.rows[owner][id_index] if id_index is not None else None
+        rows.append((batch.row_numbers[owner], tweet_id, chunks.numbers[i], start, end, chunks.tokens[i]))
+    chunk_writer.write(rows, batch.chunk_embeddings[positions], columns=CHUNK_COLUMNS)
+
+
+def skip_embedded(batches, embedded, counts):
+    """
+    Drops rows whose tweet_id is already in the embedded set, a whole batch at a time, and
+    attaches the parsed ids of the remaining rows to each batch as batch.ids.
+    """
+    for batch in batches:
+        if ID_COLUMN not in batch.columns:
+            raise ValueError(f"--incremental needs the '{ID_COLUMN}' column in the output")
+        id_index = batch.columns.index(ID_COLUMN)
+        ids = parse_ids([row[id_index] for row in batch.rows])
+        seen = embedded.seen_mask(ids)
+        if seen.any():
+            keep = np.flatnonzero(~seen)
+            counts['skipped_rows'] += len(ids) - len(keep)
+            batch.rows = [batch.rows[i] for i in keep]
+            batch.texts = [batch.texts[i] for i in keep]
+            batch.row_numbers = [batch.row_numbers[i] for i in keep]
+            ids = ids[keep]
+        batch.ids = ids
+        # Empty batches still flow through so the checkpoint keeps advancing
+        yield batch
+
+
+def run_sequential(batches, encode, write, budget=None):
+    """
+    Encodes and writes each batch on the calling thread before reading the next one. With a
+    MemoryBudget only one batch is ever in flight, so it is only kept informed.
+    """
+    for batch in batches:
+        if budget is not None:
+            budget.acquire(batch)
+        encode(batch)
+        write(batch)
+        if budget is not None:
+            budget.release(batch)
+
+
+_DONE = object() # Marks the end of a stage's output
+
+
+def run_pipelined(batches, encode, write, queue_size, budget=None):
+    """
+    Runs reading, encoding and writing as three stages connected by bounded queues.
+
+    Reading and writing happen on background threads while the calling thread encodes, so
+    the model is not left idle during CSV parsing or JSON serialization. The queues bound
+    how far the reader may run ahead, and batches are written in the order they were read.
+    With a MemoryBudget, the reader also waits while the batches in flight would exceed it.
+    If any stage fails the others stop and the first error is re-raised here.
+    """
+    parsed = queue.Queue(maxsize=queue_size)
+    encoded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # Block until there is room, but give up if another stage has failed
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def read_stage():
+        try:
+            for batch in batches:
+                if budget is not None and not budget.acquire(batch, stop):
+                    return
+                if not put(parsed, batch):
+                    return
+            put(parsed, _DONE)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def write_stage():
+        try:
+            while True:
+                batch = get(encoded)
+                if batch is _DONE:
+                    return
+                write(batch)
+                if budget is not None:
+                    budget.release(batch)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    reader_thread = threading.Thread(target=read_stage, name='csv-reader', daemon=True)
+    writer_thread = threading.Thread(target=write_stage, name='jsonl-writer', daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+
+    try:
+        while True:
+            batch = get(parsed)
+            if batch is _DONE:
+                break
+            encode(batch)
+            if not put(encoded, batch):
+                break
+        put(encoded, _DONE)
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        writer_thread.join()
+        stop.set()
+        reader_thread.join()
+
+    if errors:
+        raise errors[0]
 
 
-def process_batch(batch, model, jsonlfile, text_column, device):
+def log_failed_batch(batch, error):
+    print(f"Error processing batch at row {batch.rows_read}: {error}")
+    print(f"Batch size: {len(batch.rows)}")
+    # Log problematic batch data
+    for i, text in enumerate(batch.texts):
+        print(f"  Batch item {i}: text length {len(text)}")
+
+
+def encode_texts(texts, model, device, cache=None, token_budget=None, pool=None,
+                 encode_batch_size=ENCODE_BATCH_SIZE, sizer=None, timer=None):
     """
-    Generates embeddings for a batch of records and writes them to the JSONL file.
+    Generates embeddings for a list of texts and returns them as a numpy array.
+    With a cache, only texts it doesn't already hold are sent to the model. With a
+    token_budget, texts are encoded in length buckets (see encode_bucketed). With a
+    pool, the work is spread across its worker processes instead of using model.
+    With a sizer, forward passes are sized adaptively (see encode_adaptive). With a timer
+    (see stage_timing.py), validation and model time are recorded on it.
     """
     try:
-        texts = [row[text_column] for row in batch]
+        texts = list(texts)
         print(f"Processing batch of {len(texts)} texts...")
-        
+
         # Validate texts
-        for i, text in enumerate(texts):
-            if not isinstance(text, str):
-                print(f"Warning: Non-string text at index {i}: {type(text)} - {text}")
-                texts[i] = str(text)
-            elif len(text.strip()) == 0:
-                print(f"Warning: Empty text at index {i}")
-        
-        print(f"Generating embeddings...")
-        embeddings = model.encode(
-            texts,
-            show_progress_bar=False, # Progress is shown by row count in main loop
-            device=device,
-            batch_size=min(32, len(texts))  # Smaller sub-batches to avoid memory issues
-        )
+        with timed(timer, 'validate'):
+            for i, text in enumerate(texts):
+                if not isinstance(text, str):
+                    print(f"Warning: Non-string text at index {i}: {type(text)} - {text}")
+                    texts[i] = str(text)
+                elif len(text.strip()) == 0:
+                    print(f"Warning: Empty text at index {i}")
+
+        def encode(texts):
+            print(f"Generating embeddings for {len(texts)} texts...")
+            if pool is not None:
+                if token_budget:
+                    chunks = plan_buckets(texts, model.max_seq_length, token_budget)
+                else:
+                    chunks = [(list(range(start, min(start + WORKER_CHUNK_SIZE, len(texts)))), encode_batch_size)
+                              for start in range(0, len(texts), WORKER_CHUNK_SIZE)]
+                return pool.encode(texts, chunks, timer)
+            started = timer.encode_started() if timer is not None else None
+            if token_budget:
+                embeddings = encode_bucketed(texts, model, device, token_budget)
+            elif sizer is not None:
+                embeddings = encode_adaptive(texts, model, device, sizer)
+            else:
+                embeddings = model.encode(
+                    texts,
+                    show_progress_bar=False, # Progress is shown by row count in main loop
+                    device=device,
+                    batch_size=min(encode_batch_size, len(texts))  # Smaller sub-batches to avoid memory issues
+                )
+            if timer is not None:
+                timer.encode_finished(started, len(texts))
+            return embeddings
+
+        if cache is None:
+            embeddings = encode(texts)
+        else:
+            embeddings = cache.encode(texts, encode)
         print(f"Generated {len(embeddings)} embeddings with shape {embeddings.shape}")
+        return embeddings
 
-        # Add embeddings to the records and write to file
-        for i, record in enumerate(batch):
-            try:
-                embedding_list = embeddings[i].tolist()
-                record['full_text_vector'] = embedding_list
-                json_line = json.dumps(record)
-                jsonlfile.write(json_line + '\n')
-            except Exception as e:
-                print(f"Error processing record {i}: {e}")
-                print(f"Record: {record}")
-                print(f"Embedding shape: {embeddings[i].shape if i < len(embeddings) else 'N/A'}")
-                raise
-                
     except Exception as e:
-        print(f"Error in process_batch: {e}")
-        print(f"Batch size: {len(batch)}")
+        print(f"Error in encode_texts: {e}")
+        print(f"Batch size: {len(texts)}")
         print(f"Device: {device}")
         import traceback
         traceback.print_exc()
         raise
 
+
+def approx_token_count(text, max_seq_length):
+    """
+    Estimates the padded length a text will take in a batch, without running the tokenizer.
+    """
+    return min(max_seq_length, math.ceil(len(text) / CHARS_PER_TOKEN) + 2) # +2 for [CLS]/[SEP]
+
+
+def plan_buckets(texts, max_seq_length, token_budget):
+    """
+    Groups texts longest first into buckets of similar length, each with as many texts as fit
+    in token_budget padded tokens. Returns a list of (indices, batch_size) pairs.
+    """
+    lengths = [approx_token_count(text, max_seq_length) for text in texts]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i], reverse=True)
+    buckets = []
+    padded_tokens = 0
+
+    start = 0
+    while start < len(order):
+        # Sorted longest first, so the first text sets the padded length of the bucket
+        longest = lengths[order[start]]
+        size = max(1, min(BUCKET_MAX_BATCH_SIZE, token_budget // longest))
+        bucket = order[start:start + size]
+        buckets.append((bucket, len(bucket)))
+        padded_tokens += longest * len(bucket)
+        start += size
+
+    if buckets:
+        print(f"Bucketed {len(texts)} texts into {len(buckets)} forward passes "
+              f"(~{sum(lengths) / padded_tokens:.0%} of padded tokens are real)")
+    return buckets
+
+
+def scatter_chunks(num_texts, chunks, chunk_embeddings, dim):
+    """
+    Puts the embeddings of each (indices, batch_size) chunk back into input order.
+    """
+    embeddings = None
+    for (indices, _), vectors in zip(chunks, chunk_embeddings):
+        if embeddings is None:
+            embeddings = np.empty((num_texts, vectors.shape[1]), dtype=vectors.dtype)
+        embeddings[indices] = vectors
+    if embeddings is None:
+        return np.empty((0, dim), dtype=np.float32)
+    return embeddings
+
+
+def encode_bucketed(texts, model, device, token_budget):
+    """
+    Encodes texts in length buckets (see plan_buckets) and returns the embeddings in the
+    original order.
+    """
+    chunks = plan_buckets(texts, model.max_seq_length, token_budget)
+    chunk_embeddings = (
+        model.encode(
+            [texts[i] for i in indices],
+            show_progress_bar=False,
+            device=device,
+            batch_size=batch_size
+        )
+        for indices, batch_size in chunks
+    )
+    return scatter_chunks(len(texts), chunks, chunk_embeddings, model.get_sentence_embedding_dimension())
+
+
+def encode_adaptive(texts, model, device, sizer):
+    """
+    Encodes texts in forward passes of sizer.size texts, feeding the throughput of each pass
+    back to sizer. A pass that runs out of memory is retried at half the size.
+    """
+    parts = []
+    start = 0
+    while start < len(texts):
+        chunk = texts[start:start + sizer.size]
+        began = time.perf_counter()
+        try:
+            vectors = model.encode(chunk, show_progress_bar=False, device=device, batch_size=len(chunk))
+        except Exception as e:
+            if not is_out_of_memory(e) or not sizer.backoff():
+                raise
+            if device == 'cuda':
+                import torch
+                torch.cuda.empty_cache()
+            continue
+        tokens = sum(approx_token_count(text, model.max_seq_length) for text in chunk)
+        sizer.record(len(chunk), tokens, time.perf_counter() - began)
+        parts.append(vectors)
+        start += len(chunk)
+    if not parts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.concatenate(parts)
+
+
+# --- Multi-process CPU encoding ---
+_worker_model = None
+_worker_timer = None
+
+
+def _init_worker(model_name, backend, onnx_quantization, threads, next_worker, ready_workers):
+    """
+    Loads the model in a worker process and pins it to its own share of the cores.
+    """
+    global _worker_model, _worker_timer
+    with next_worker.get_lock():
+        worker_index = next_worker.value
+        next_worker.value += 1
+    import torch
+    torch.set_num_threads(threads)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        first = worker_index * threads
+        if first + threads <= len(cores):
+            os.sched_setaffinity(0, cores[first:first + threads])
+    _worker_model = load_model(model_name, backend, 'cpu', onnx_quantization, threads)
+    _worker_timer = StageTimer()
+    _worker_timer.instrument_model(_worker_model)
+    with ready_workers.get_lock():
+        ready_workers.value += 1
+
+
+def _worker_pid():
+    return os.getpid()
+
+
+def _encode_in_worker(texts, batch_size):
+    start = time.perf_counter()
+    tokenize_before, tokens_before = _worker_timer.seconds['tokenize'], _worker_timer.tokens
+    embeddings = _worker_model.encode(texts, show_progress_bar=False, device='cpu', batch_size=batch_size)
+    timing = {
+        'tokenize_seconds': _worker_timer.seconds['tokenize'] - tokenize_before,
+        'tokens': _worker_timer.tokens - tokens_before,
+        'peak_rss': peak_rss_bytes(),
+    }
+    return embeddings, os.getpid(), len(texts), time.perf_counter() - start, timing
+
+
+class EncoderPool:
+    """
+    A pool of worker processes, each holding its own copy of the model on the CPU.
+    """
+    def __init__(self, model_name, backend, onnx_quantization, workers, threads_per_worker):
+        # spawn rather than fork: forking a process that has already started torch's
+        # thread pools can deadlock the children
+        context = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.ready_workers = context.Value('i', 0)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model_name, backend, onnx_quantization, threads_per_worker, context.Value('i', 0),
+                      self.ready_workers),
+        )
+        self.started = time.perf_counter()
+        self.worker_stats = {} # pid -> [texts encoded, seconds spent encoding]
+
+    def wait_ready(self):
+        """
+        Starts every worker and waits until each has loaded its model. The executor only starts
+        a process when a task is submitted, and a worker that is ready first can take several.
+        """
+        for future in [self.executor.submit(_worker_pid) for _ in range(self.workers)]:
+            future.result()
+        while self.ready_workers.value < self.workers:
+            # Raises if a worker died loading the model
+            self.executor.submit(_worker_pid).result()
+            time.sleep(0.05)
+        self.started = time.perf_counter()
+
+    def encode(self, texts, chunks, timer=None):
+        """
+        Encodes each (indices, batch_size) chunk of texts on whichever worker is free and
+        returns all the embeddings in input order. The workers' tokenize and forward times
+        are added to timer.
+        """
+        futures = [
+            self.executor.submit(_encode_in_worker, [texts[i] for i in indices], batch_size)
+            for indices, batch_size in chunks
+        ]
+        chunk_embeddings = []
+        for future in futures:
+            embeddings, pid, count, seconds, timing = future.result()
+            stats = self.worker_stats.setdefault(pid, [0, 0.0])
+            stats[0] += count
+            stats[1] += seconds
+            if timer is not None:
+                timer.add('tokenize', timing['tokenize_seconds'])
+                timer.add('forward', max(0.0, seconds - timing['tokenize_seconds']))
+                timer.count(texts=count, tokens=timing['tokens'])
+                if timing['peak_rss'] is not None:
+                    timer.worker_peak_rss[pid] = timing['peak_rss']
+            chunk_embeddings.append(embeddings)
+        return scatter_chunks(len(texts), chunks, chunk_embeddings, 0)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        total = sum(count for count, _ in self.worker_stats.values())
+        lines = [f"Workers encoded {total} texts in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} texts/s overall)"]
+        for pid, (count, seconds) in sorted(self.worker_stats.items()):
+            lines.append(f"  Worker {pid}: {count} texts in {seconds:.1f}s busy "
+                         f"({count / max(seconds, 1e-9):.1f} texts/s)")
+        return lines
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
 if __name__ == "__main__":
     main()
@@ -15,7 +15,60 @@ const client = new Client({
   log: 'trace', // Enable verbose logging
 });
 
-async function ingestJSONL(filePath: string) {
+// Creates the index if it doesn't exist, with a vector field of the given dimension: 384 for
+// all-MiniLM-L6-v2, but other models and --reduce-dim output differ. An existing index must
+// already have that dimension.
+async function ensureIndex(dimension: number) {
+  console.log(`Checking if index "${INDEX_NAME}" exists...`);
+  const { body: indexExists } = await client.indices.exists({ index: INDEX_NAME });
+  console.log(`Index exists: ${indexExists}`);
+  if (indexExists) {
+    const { body: mapping } = await client.indices.getMapping({ index: INDEX_NAME });
+    const existing = mapping[INDEX_NAME]?.mappings?.properties?.full_text_vector?.dimension;
+    if (existing !== undefined && existing !== dimension) {
+      throw new Error(`Index "${INDEX_NAME}" has ${existing}-dimension vectors, but the input has ${dimension}`);
+    }
+    console.log(`Index "${INDEX_NAME}" already exists.`);
+    return;
+  }
+  console.log(`Index "${INDEX_NAME}" does not exist. Creating with ${dimension}-dimension vectors...`);
+  try {
+    const createResponse = await client.indices.create({
+      index: INDEX_NAME,
+      body: {
+        settings: {
+            "index.knn": true,
+        },
+        mappings: {
+          properties: {
+            tweet_id: { type: 'keyword' },
+            account_id: { type: 'keyword' },
+            created_at: { type: 'date' }, // Use default date mapping
+            full_text: { type: 'text' },
+            retweet_count: { type: 'integer' },
+            favorite_count: { type: 'integer' },
+            reply_to_tweet_id: { type: 'keyword' },
+            reply_to_user_id: { type: 'keyword' },
+            reply_to_username: { type: 'keyword' },
+            username: { type: 'keyword' },
+            dup_group_id: { type: 'keyword' }, // Set by generate_embeddings.py --dedup
+            full_text_vector: {
+              type: 'knn_vector',
+              dimension: dimension, // From the model, or generate_embeddings.py --reduce-dim
+            },
+          },
+        },
+      },
+    });
+    console.log('Index creation response:', JSON.stringify(createResponse.body, null, 2));
+  } catch (error) {
+    console.error('Failed to create index:', error);
+    throw error;
+  }
+  console.log(`Index "${INDEX_NAME}" created.`);
+}
+
+async function ingestJSONL(filePath: string, dimension?: number) {
   console.log(`Starting ingestion of ${filePath} into index "${INDEX_NAME}"...`);
   console.log(`OpenSearch URL: ${process.env.OPENSEARCH_URL || 'http://localhost:9200'}`);
   
@@ -37,47 +90,12 @@ async function ingestJSONL(filePath: string) {
   let batch: any[] = [];
   let rowCount = 0;
 
-  // Check if the index exists, and create it if it doesn't
-  console.log(`Checking if index "${INDEX_NAME}" exists...`);
-  const { body: indexExists } = await client.indices.exists({ index: INDEX_NAME });
-  console.log(`Index exists: ${indexExists}`);
-  if (!indexExists) {
-    console.log(`Index "${INDEX_NAME}" does not exist. Creating...`);
-    try {
-      const createResponse = await client.indices.create({
-        index: INDEX_NAME,
-        body: {
-          settings: {
-              "index.knn": true,
-          },
-          mappings: {
-            properties: {
-              tweet_id: { type: 'keyword' },
-              account_id: { type: 'keyword' },
-              created_at: { type: 'date' }, // Use default date mapping
-              full_text: { type: 'text' },
-              retweet_count: { type: 'integer' },
-              favorite_count: { type: 'integer' },
-              reply_to_tweet_id: { type: 'keyword' },
-              reply_to_user_id: { type: 'keyword' },
-              reply_to_username: { type: 'keyword' },
-              username: { type: 'keyword' },
-              full_text_vector: {
-                type: 'knn_vector',
-                dimension: 384, // From the sentence-transformers model
-              },
-            },
-          },
-        },
-      });
-      console.log('Index creation response:', JSON.stringify(createResponse.body, null, 2));
-    } catch (error) {
-      console.error('Failed to create index:', error);
-      throw error;
-    }
-    console.log(`Index "${INDEX_NAME}" created.`);
-  } else {
-    console.log(`Index "${INDEX_NAME}" already exists.`);
+  // The index is created once the vector dimension is known: from --dimension, or else from
+  // the first record
+  let indexReady = false;
+  if (dimension !== undefined) {
+    await ensureIndex(dimension);
+    indexReady = true;
   }
 
   for await (const line of rl) {
@@ -93,6 +111,15 @@ async function ingestJSONL(filePath: string) {
       continue;
     }
 
+    if (!indexReady) {
+      const vector = record.full_text_vector;
+      if (!Array.isArray(vector)) {
+        throw new Error(`Line ${rowCount + 1} has no full_text_vector to take the dimension from; pass --dimension`);
+      }
+      await ensureIndex(vector.length);
+      indexReady = true;
+    }
+
     // Convert created_at to ISO 8601 format before indexing
     if (record.created_at) {
       try {
@@ -191,15 +218,19 @@ async function sendBulkRequest(batch: any[], retryCount = 0) {
 
 // --- Script execution ---
 async function main() {
-  const filePath = process.argv[2];
-  if (!filePath) {
+  const args = process.argv.slice(2);
+  const filePath = args.find((arg, i) => !arg.startsWith('--') && args[i - 1] !== '--dimension');
+  const dimensionIndex = args.indexOf('--dimension');
+  const dimension = dimensionIndex >= 0 ? parseInt(args[dimensionIndex + 1], 10) : undefined;
+  if (!filePath || (dimension !== undefined && !(dimension > 0))) {
     console.error('Please provide the path to the JSONL file.');
-    console.error('Usage: bun ingest_jsonl.ts <path-to-jsonl-file>');
+    console.error('Usage: bun ingest_jsonl.ts <path-to-jsonl-file> [--dimension N]');
+    console.error('  --dimension N  Vector dimension of a new index (default: that of the first record)');
     process.exit(1);
   }
 
   try {
-    await ingestJSONL(filePath);
+    await ingestJSONL(filePath, dimension);
   } catch (error) {
     console.error('An unexpected error occurred:');
     console.error('Error name:', error.name);
@@ -0,0 +1,132 @@
+'''
+Chunked embedding of long texts for generate_embeddings.py --chunk-long-texts.
+
+The model only sees the first max_seq_length tokens of a text, so a long thread would otherwise
+be represented by its opening sentences. Instead, texts longer than the model's window are split
+into overlapping windows of tokens, every chunk of a batch goes through the model together with
+the short texts in the same batched calls, and each text's chunk vectors are pooled back into a
+single vector: a plain mean, or weighted by the number of tokens in each chunk so a short final
+chunk counts for less.
+
+Chunks are cut at the tokenizer's character offsets, so each one is a substring of the original
+text and is tokenized back into (nearly) the same tokens by the model.
+'''
+import numpy as np
+
+POOLING_METHODS = ['mean', 'weighted']
+# Used to cut chunks when the tokenizer can't report character offsets (slow tokenizers)
+CHARS_PER_TOKEN = 4
+
+
+class ChunkPlan:
+    """
+    The chunks of a list of texts. owners[i] is the index of the text chunk i came from,
+    and spans[i] the (start, end) characters of the chunk in that text.
+    """
+    def __init__(self, num_texts):
+        self.num_texts = num_texts
+        self.texts = []
+        self.owners = []
+        self.numbers = [] # Position of each chunk within its text
+        self.spans = []
+        self.tokens = []
+
+    def add(self, owner, number, text, span, tokens):
+        self.owners.append(owner)
+        self.numbers.append(number)
+        self.texts.append(text)
+        self.spans.append(span)
+        self.tokens.append(tokens)
+
+    def chunked_texts(self):
+        """
+        Indices of the texts that were split into more than one chunk.
+        """
+        counts = np.bincount(np.asarray(self.owners, dtype=np.int64), minlength=self.num_texts)
+        return np.flatnonzero(counts > 1)
+
+
+class TextChunker:
+    """
+    Splits texts into windows of at most window tokens that overlap by overlap tokens, and
+    pools chunk embeddings back into one vector per text.
+    """
+    def __init__(self, tokenizer, window, overlap, pooling='mean'):
+        if not 0 <= overlap < window:
+            raise ValueError(f"Chunk overlap ({overlap}) must be smaller than the window ({window})")
+        if pooling not in POOLING_METHODS:
+            raise ValueError(f"Unknown pooling method {pooling}, expected one of {POOLING_METHODS}")
+        self.tokenizer = tokenizer
+        self.window = window
+        self.overlap = overlap
+        self.pooling = pooling
+        # Run statistics
+        self.texts_seen = 0
+        self.texts_chunked = 0
+        self.chunks = 0
+
+    def split(self, texts):
+        """
+        Returns a ChunkPlan for texts. Every wordpiece covers at least one character, so texts
+        no longer than the window are kept whole without running the tokenizer on them.
+        """
+        plan = ChunkPlan(len(texts))
+        long_indices = [i for i, text in enumerate(texts) if len(text) > self.window]
+        offsets = dict(zip(long_indices, self._token_offsets([texts[i] for i in long_indices])))
+
+        for i, text in enumerate(texts):
+            spans = offsets.get(i)
+            if spans is None or len(spans) <= self.window:
+                plan.add(i, 0, text, (0, len(text)), len(spans) if spans is not None else None)
+                continue
+            step = self.window - self.overlap
+            for number, start in enumerate(range(0, len(spans) - self.overlap, step)):
+                window = spans[start:start + self.window]
+                begin, end = window[0][0], window[-1][1]
+                plan.add(i, number, text[begin:end], (begin, end), len(window))
+            self.texts_chunked += 1
+
+        self.texts_seen += len(texts)
+        self.chunks += len(plan.texts)
+        return plan
+
+    def _token_offsets(self, texts):
+        """
+        Returns the (start, end) character offsets of every token of each text.
+        """
+        if not texts:
+            return []
+        if getattr(self.tokenizer, 'is_fast', False):
+            encoded = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True,
+                                     return_attention_mask=False, return_token_type_ids=False)
+            return encoded['offset_mapping']
+        # Without offsets, pretend every CHARS_PER_TOKEN characters are a token
+        return [[(start, min(start + CHARS_PER_TOKEN, len(text))) for start in range(0, len(text), CHARS_PER_TOKEN)]
+                for text in texts]
+
+    def pool(self, plan, chunk_embeddings):
+        """
+        Combines the chunk embeddings of each text into one vector. If the model produces
+        unit-length vectors, so does the pooling.
+        """
+        chunk_embeddings = np.asarray(chunk_embeddings, dtype=np.float32)
+        owners = np.asarray(plan.owners, dtype=np.int64)
+        if len(owners) == plan.num_texts:
+            return chunk_embeddings # Nothing was split
+
+        if self.pooling == 'weighted':
+            weights = np.array([tokens or 1 for tokens in plan.tokens], dtype=np.float32)
+        else:
+            weights = np.ones(len(owners), dtype=np.float32)
+        pooled = np.zeros((plan.num_texts, chunk_embeddings.shape[1]), dtype=np.float32)
+        np.add.at(pooled, owners, chunk_embeddings * weights[:, None])
+        pooled /= np.bincount(owners, weights=weights, minlength=plan.num_texts)[:, None].astype(np.float32)
+
+        norms = np.linalg.norm(chunk_embeddings, axis=1)
+        if np.allclose(norms, 1.0, atol=1e-3):
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled
+
+    def summary(self):
+        return (f"Chunking: {self.texts_chunked} of {self.texts_seen} texts split, "
+                f"{self.chunks} chunks encoded ({self.chunks / max(self.texts_seen, 1):.2f} per text)")
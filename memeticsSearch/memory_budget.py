@@ -0,0 +1,169 @@
+'''
+Bounded-memory mode for generate_embeddings.py --max-memory-mb, for backfills on small machines
+shared with other jobs.
+
+Once the model is loaded and the outputs are open, the resident memory of the process is the
+baseline the run can't do without. What is left under the ceiling, less what the run's fixed
+structures (the --dedup index, the parallel CSV reader's read-ahead) will grow into and some
+headroom for the model's activations, is the budget for batches in flight. Every batch is
+charged its estimated size (its rows and texts as Python objects, plus the vectors it will get)
+when the reader hands it on, and refunded once it has been written. The reader waits while the
+batches in flight would go over the budget, or while the process is over the ceiling, so a
+slow writer or a long run of big batches can't pile up rows in the pipeline queues.
+
+A batch is always let through when nothing else is in flight, so a single batch bigger than
+the budget still runs (a warning says to lower --batch-size or --bucket-window). Waiting for
+memory to come back, the reader runs the garbage collector and, with glibc, returns freed heap
+pages to the system.
+
+The resident size is read from /proc, so the ceiling itself is only checked on Linux; elsewhere
+only the batch budget applies.
+'''
+import ctypes
+import ctypes.util
+import gc
+import os
+import sys
+import threading
+import time
+
+# Share of the ceiling kept free for tokenizer output and the forward pass's activations
+HEADROOM = 0.15
+POLL_SECONDS = 0.05
+MB = 1024 * 1024 # As in --max-memory-mb
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c')) if sys.platform.startswith('linux') else None
+    _malloc_trim = _libc.malloc_trim if _libc is not None else None
+except (OSError, AttributeError): # Not glibc
+    _malloc_trim = None
+
+
+def current_rss_bytes():
+    """
+    The current resident set size of this process, or None where it can't be measured.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def release_free_memory():
+    """
+    Collects garbage and hands freed heap pages back to the system, where glibc allows it.
+    """
+    gc.collect()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+
+
+def batch_bytes(batch, vector_bytes_per_row=0):
+    """
+    Estimates the memory batch holds once encoded: its rows and texts as Python objects, and
+    vector_bytes_per_row for each of its vectors.
+    """
+    total = sys.getsizeof(batch.rows) + sys.getsizeof(batch.texts)
+    for row in batch.rows:
+        total += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    for row, text in zip(batch.rows, batch.texts):
+        # Texts that weren't stripped or truncated are the rows' own strings
+        if not any(value is text for value in row):
+            total += sys.getsizeof(text)
+    return total + len(batch.rows) * vector_bytes_per_row
+
+
+class MemoryBudget:
+    """
+    Holds back the reader while the batches in flight would take the process over max_bytes.
+    acquire and release are called from different pipeline stages.
+    """
+    def __init__(self, max_bytes, vector_bytes_per_row=0):
+        self.max_bytes = max_bytes
+        self.vector_bytes_per_row = vector_bytes_per_row
+        self.budget = max_bytes
+        self.baseline = None
+        self.reserved = 0
+        self.in_flight = {} # id(batch) -> charged bytes
+        self.in_flight_bytes = 0
+        self.condition = threading.Condition()
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.max_in_flight_bytes = 0
+        self.oversized = 0
+
+    def start(self, reserved=0):
+        """
+        Sets the batch budget from the current resident size, which should include the model,
+        and reserved bytes that the run's fixed structures will still grow into.
+        """
+        self.baseline = current_rss_bytes()
+        self.reserved = reserved
+        self.budget = int(self.max_bytes * (1 - HEADROOM)) - (self.baseline or 0) - reserved
+        if self.budget <= 0:
+            print(f"Warning: the model and run structures already take {((self.baseline or 0) + reserved) / MB:.0f} MB "
+                  f"of the {self.max_bytes / MB:.0f} MB ceiling; batches will run one at a time "
+                  f"(a smaller --batch-size needs less)")
+            self.budget = 0
+        return self.budget
+
+    def _over_ceiling(self):
+        rss = current_rss_bytes()
+        return rss is not None and rss > self.max_bytes
+
+    def acquire(self, batch, stop=None):
+        """
+        Charges batch to the budget, first waiting until it fits or nothing else is in flight.
+        Returns False if stop was set while waiting.
+        """
+        size = batch_bytes(batch, self.vector_bytes_per_row)
+        started = None
+        with self.condition:
+            while self.in_flight_bytes and (self.in_flight_bytes + size > self.budget or self._over_ceiling()):
+                if stop is not None and stop.is_set():
+                    return False
+                if started is None:
+                    started = time.perf_counter()
+                    self.pauses += 1
+                    release_free_memory()
+                self.condition.wait(POLL_SECONDS)
+            if started is not None:
+                self.paused_seconds += time.perf_counter() - started
+            if size > self.budget:
+                if not self.oversized:
+                    print(f"Warning: a batch of {len(batch.rows)} rows takes about {size / MB:.0f} MB, more than the "
+                          f"{self.budget / MB:.0f} MB budget for batches; lower --batch-size or --bucket-window")
+                self.oversized += 1
+            self.in_flight[id(batch)] = size
+            self.in_flight_bytes += size
+            self.max_in_flight_bytes = max(self.max_in_flight_bytes, self.in_flight_bytes)
+        return True
+
+    def release(self, batch):
+        with self.condition:
+            self.in_flight_bytes -= self.in_flight.pop(id(batch), 0)
+            self.condition.notify_all()
+
+    def stats(self):
+        return {
+            'max_bytes': self.max_bytes,
+            'baseline_bytes': self.baseline,
+            'reserved_bytes': self.reserved,
+            'budget_bytes': self.budget,
+            'max_in_flight_bytes': self.max_in_flight_bytes,
+            'pauses': self.pauses,
+            'paused_seconds': self.paused_seconds,
+            'oversized_batches': self.oversized,
+        }
+
+    def summary(self):
+        baseline = f"{self.baseline / MB:.0f} MB" if self.baseline is not None else 'unknown'
+        return (f"Memory: ceiling {self.max_bytes / MB:.0f} MB, baseline {baseline}, batch budget "
+                f"{self.budget / MB:.0f} MB (at most {self.max_in_flight_bytes / MB:.0f} MB in flight); "
+                f"reader paused {self.pauses} times for {self.paused_seconds:.1f}s")
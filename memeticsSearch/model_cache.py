@@ -0,0 +1,73 @@
+'''
+Where generate_embeddings.py finds its model, so a run can start without touching the network.
+
+--model-cache DIR pins the directory models are downloaded to and loaded from (it sets
+SENTENCE_TRANSFORMERS_HOME, so the --workers processes and the ONNX export use it as well). The
+first run downloads the model there; after that, --offline turns off every Hugging Face Hub call
+and loads the cached snapshot straight from its directory, which skips the hub's lookups of the
+model files as well as the network.
+
+Both have to be set up before sentence_transformers (and huggingface_hub under it) is imported,
+since the hub reads its settings at import time; generate_embeddings.py imports it lazily for
+that reason.
+'''
+import glob
+import os
+
+# Organization sentence-transformers prefixes to model names without one, like all-MiniLM-L6-v2
+HUB_ORGANIZATION = 'sentence-transformers'
+
+
+def configure_model_cache(cache_dir=None, offline=False):
+    if cache_dir:
+        os.environ['SENTENCE_TRANSFORMERS_HOME'] = os.path.abspath(cache_dir)
+    if offline:
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        os.environ['TRANSFORMERS_OFFLINE'] = '1'
+
+
+def default_hub_cache():
+    """
+    The directory huggingface_hub caches downloads in when no cache folder is given.
+    """
+    if os.environ.get('HF_HUB_CACHE'):
+        return os.environ['HF_HUB_CACHE']
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(os.environ.get('HF_HOME', os.path.join(cache_home, 'huggingface')), 'hub')
+
+
+def cached_snapshot(model_name, cache_dir=None):
+    """
+    Returns the directory of the cached snapshot of model_name (the one refs/main points to, or
+    else the newest), or None if it hasn't been downloaded to cache_dir.
+    """
+    cache_dir = cache_dir or os.environ.get('SENTENCE_TRANSFORMERS_HOME') or default_hub_cache()
+    repo_ids = [model_name] if '/' in model_name else [f'{HUB_ORGANIZATION}/{model_name}', model_name]
+    for repo_id in repo_ids:
+        repo_dir = os.path.join(cache_dir, 'models--' + repo_id.replace('/', '--'))
+        ref_path = os.path.join(repo_dir, 'refs', 'main')
+        if os.path.exists(ref_path):
+            with open(ref_path) as f:
+                snapshots = [os.path.join(repo_dir, 'snapshots', f.read().strip())]
+        else:
+            snapshots = sorted(glob.glob(os.path.join(repo_dir, 'snapshots', '*')), key=os.path.getmtime, reverse=True)
+        for snapshot in snapshots:
+            if any(os.path.exists(os.path.join(snapshot, name)) for name in ('modules.json', 'config.json')):
+                return snapshot
+    return None
+
+
+def resolve_model(model_name, cache_dir=None, offline=False):
+    """
+    Returns what to load model_name from: a local directory as is, the cached snapshot when
+    offline, and otherwise the name itself. Raises right away if an offline run has no copy of
+    the model, rather than after the hub gives up.
+    """
+    if os.path.isdir(model_name) or not offline:
+        return model_name
+    snapshot = cached_snapshot(model_name, cache_dir)
+    if snapshot is None:
+        location = cache_dir or os.environ.get('SENTENCE_TRANSFORMERS_HOME') or default_hub_cache()
+        raise FileNotFoundError(f"Model '{model_name}' is not cached in {location}; "
+                                f"run once without --offline to download it")
+    return snapshot
@@ -0,0 +1,245 @@
+'''
+Near-duplicate detection for generate_embeddings.py --dedup.
+
+Copypasta and lightly edited copies of a tweet make up a good part of the archive, and embedding
+each copy separately spends the encoder on the same content thousands of times. With --dedup
+every text gets a MinHash signature over its character shingles, and LSH banding finds earlier
+texts whose signatures share a band. A candidate whose signature agrees on at least `threshold`
+of its values (an estimate of the Jaccard similarity of the two shingle sets) makes the text a
+member of that text's group. Only the first text of each group, its representative, is
+embedded; every member is written with the representative's vector. Each row gets a
+dup_group_id, the tweet_id of its group's representative (its own for texts with no earlier
+copy), so the copypasta clusters come with the output.
+
+Texts are compared lowercased and with whitespace collapsed; with --normalize-text, after links,
+leading @mentions and HTML entities are removed as well.
+
+The index remembers the `capacity` most recent groups, with their signatures and vectors (one
+per model when several are run), and forgets the oldest beyond that, so memory stays bounded on
+any input: roughly capacity * (4 * dim + 4 * NUM_PERMUTATIONS + 100 * BANDS) bytes, about 350 MB
+for the default 100,000 groups of 384-dimension vectors from one model. Signatures are computed
+over bounded blocks of characters and shingles, so signing a batch takes at most another
+SIGNATURE_BYTES (about 128 MB) however long its texts are. A copy that turns up after its group
+has been forgotten starts a new group. The index is not saved in checkpoints either, so groups
+also start afresh after --resume.
+'''
+import numpy as np
+
+SHINGLE_SIZE = 5 # Characters per shingle
+# 16 bands of 4 rows: texts with a Jaccard similarity of 0.5 become candidates 1 - (1 - 0.5**4)**16
+# = 64% of the time, of 0.8 over 99.9%, and candidates are then checked against the threshold
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+DEDUP_THRESHOLD = 0.8
+DEDUP_CAPACITY = 100000
+# Characters hashed at a time, which bounds the per-window arrays whatever the text lengths
+SIGNATURE_CHARS = 1 << 20
+# Windows permuted at a time: the (windows, NUM_PERMUTATIONS) uint64 matrix is 32 MB
+SIGNATURE_WINDOWS = 1 << 16
+# Most memory signing a chunk takes: two uint64 temporaries and the uint32 result per window
+# permuted, and about six 8-byte values per character for the codes, hashes and positions
+SIGNATURE_BYTES = SIGNATURE_WINDOWS * NUM_PERMUTATIONS * 20 + SIGNATURE_CHARS * 48
+SEED = 20240601
+
+_random = np.random.default_rng(SEED)
+# Odd multipliers and offsets of the multiply-shift hash functions standing in for permutations
+_MULTIPLIERS = _random.integers(1, 2 ** 63, NUM_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _random.integers(0, 2 ** 63, NUM_PERMUTATIONS, dtype=np.uint64)
+_BAND_MULTIPLIERS = _random.integers(1, 2 ** 63, (BANDS, ROWS_PER_BAND), dtype=np.uint64) | np.uint64(1)
+_SHINGLE_BASE = np.uint64(1000003)
+
+
+def _signature_chunk(texts):
+    cleaned = [' '.join(text.lower().split()).ljust(SHINGLE_SIZE) for text in texts]
+    lengths = np.array([len(text) for text in cleaned])
+    codes = np.frombuffer(''.join(cleaned).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+
+    # Polynomial hash of every window of SHINGLE_SIZE characters in the joined text
+    windows = len(codes) - SHINGLE_SIZE + 1
+    hashes = np.zeros(windows, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        hashes = hashes * _SHINGLE_BASE + codes[offset:offset + windows]
+
+    # Keep only the windows that lie within one text
+    counts = lengths - SHINGLE_SIZE + 1
+    firsts = np.cumsum(counts) - counts
+    starts = np.cumsum(lengths) - lengths
+    positions = np.repeat(starts - firsts, counts) + np.arange(counts.sum())
+    shingles = hashes[positions]
+
+    # Permute a block of windows at a time and fold each text's part of the block into its minimum
+    owners = np.repeat(np.arange(len(texts)), counts)
+    signatures = np.full((len(texts), NUM_PERMUTATIONS), np.iinfo(np.uint32).max, dtype=np.uint32)
+    for start in range(0, len(shingles), SIGNATURE_WINDOWS):
+        block = shingles[start:start + SIGNATURE_WINDOWS]
+        block_owners = owners[start:start + SIGNATURE_WINDOWS]
+        permuted = ((block[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)).astype(np.uint32)
+        bounds = np.flatnonzero(np.r_[True, block_owners[1:] != block_owners[:-1]])
+        rows = block_owners[bounds]
+        signatures[rows] = np.minimum(signatures[rows], np.minimum.reduceat(permuted, bounds, axis=0))
+    return signatures
+
+
+def _chunks(texts):
+    """
+    Splits texts into runs of at most SIGNATURE_CHARS characters (or a single longer text).
+    """
+    start, chars = 0, 0
+    for i, text in enumerate(texts):
+        if i > start and chars + len(text) > SIGNATURE_CHARS:
+            yield texts[start:i]
+            start, chars = i, 0
+        chars += len(text)
+    yield texts[start:]
+
+
+def minhash_signatures(texts):
+    """
+    Returns a (len(texts), NUM_PERMUTATIONS) uint32 array of MinHash signatures of the texts'
+    character shingles.
+    """
+    if not texts:
+        return np.empty((0, NUM_PERMUTATIONS), dtype=np.uint32)
+    return np.concatenate([_signature_chunk(chunk) for chunk in _chunks(texts)])
+
+
+def band_keys(signatures):
+    """
+    Returns a (len(signatures), BANDS) array with one hash per band of each signature.
+    """
+    bands = signatures.astype(np.uint64).reshape(len(signatures), BANDS, ROWS_PER_BAND)
+    keys = (bands * _BAND_MULTIPLIERS).sum(axis=2)
+    # Make the keys of different bands distinct, so one dict holds them all
+    return keys ^ np.arange(BANDS, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+
+class DedupPlan:
+    """
+    The outcome of NearDuplicateIndex.assign for a batch of texts: the dup_group_id of each
+    text, the positions of the representatives that have to be encoded, and where every
+    text's vector comes from.
+    """
+    def __init__(self, group_ids, encode_positions, sources, known_slots, new_groups):
+        self.group_ids = group_ids
+        self.encode_positions = encode_positions
+        self.sources = sources # Index into the encoded vectors, or -1 for a group from an earlier batch
+        self.known_slots = known_slots # Slot of the earlier group of each text with no source
+        self.new_groups = new_groups # Group numbers of the encoded representatives
+
+
+class NearDuplicateIndex:
+    """
+    Groups texts with their near-duplicates seen earlier in the run, keeping the most recent
+    capacity groups.
+    """
+    def __init__(self, threshold=DEDUP_THRESHOLD, capacity=DEDUP_CAPACITY):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.buckets = {} # band key -> group number
+        self.signatures = np.zeros((capacity, NUM_PERMUTATIONS), dtype=np.uint32)
+        self.group_ids = [None] * capacity
+        self.vectors = {} # key -> vectors by slot, allocated by the first expand() for the key
+        self.next_group = 0
+        self.texts = 0
+        self.duplicates = 0
+        self.groups_with_copies = 0
+        self.has_copies = np.zeros(capacity, dtype=bool)
+
+    def _alive(self, group):
+        return group >= self.next_group - self.capacity
+
+    def _match(self, signature, keys):
+        """
+        Returns the group number of the earlier text signature is a near-duplicate of, or None.
+        """
+        best, best_similarity = None, self.threshold
+        for key in keys.tolist():
+            group = self.buckets.get(key)
+            if group is None:
+                continue
+            if not self._alive(group):
+                del self.buckets[key]
+                continue
+            similarity = np.count_nonzero(self.signatures[group % self.capacity] == signature) / NUM_PERMUTATIONS
+            if similarity >= best_similarity:
+                best, best_similarity = group, similarity
+        return best
+
+    def assign(self, texts, ids):
+        """
+        Finds the group of every text (ids are their tweet_ids) and returns a DedupPlan.
+        Texts matching nothing start groups of their own and have to be encoded.
+        """
+        if len(texts) > self.capacity:
+            raise ValueError(f"A batch of {len(texts)} texts doesn't fit in a --dedup-capacity of {self.capacity}")
+        signatures = minhash_signatures(texts)
+        keys = band_keys(signatures)
+        group_ids = []
+        encode_positions = []
+        sources = np.full(len(texts), -1, dtype=np.int64)
+        slots = np.zeros(len(texts), dtype=np.int64)
+        new_groups = []
+        first_new_group = self.next_group
+        for i in range(len(texts)):
+            group = self._match(signatures[i], keys[i])
+            if group is None:
+                group = self.next_group
+                self.next_group += 1
+                slot = group % self.capacity
+                self.signatures[slot] = signatures[i]
+                self.group_ids[slot] = ids[i]
+                self.has_copies[slot] = False
+                for key in keys[i].tolist():
+                    self.buckets[key] = group
+                sources[i] = len(encode_positions)
+                encode_positions.append(i)
+                new_groups.append(group)
+            else:
+                slot = group % self.capacity
+                self.duplicates += 1
+                if not self.has_copies[slot]:
+                    self.has_copies[slot] = True
+                    self.groups_with_copies += 1
+                if group >= first_new_group:
+                    sources[i] = group - first_new_group
+                slots[i] = slot
+            group_ids.append(self.group_ids[slot])
+        self.texts += len(texts)
+        # Forgotten groups leave stale keys behind in buckets that never come up again
+        if len(self.buckets) > 2 * BANDS * self.capacity:
+            self.buckets = {key: group for key, group in self.buckets.items() if self._alive(group)}
+        known = sources < 0
+        return DedupPlan(group_ids, encode_positions, sources, slots[known], new_groups)
+
+    def expand(self, plan, vectors, key=None):
+        """
+        Returns the vectors of all the plan's texts given those of its new representatives,
+        which are then stored under key (one per model) for later batches.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if key not in self.vectors:
+            self.vectors[key] = np.zeros((self.capacity, vectors.shape[1]), dtype=np.float32)
+        stored = self.vectors[key]
+        expanded = np.empty((len(plan.sources), stored.shape[1]), dtype=np.float32)
+        from_batch = plan.sources >= 0
+        expanded[from_batch] = vectors[plan.sources[from_batch]]
+        # Before the new groups are stored, since they can take over the slots of old ones
+        expanded[~from_batch] = stored[plan.known_slots]
+        if plan.new_groups:
+            stored[np.asarray(plan.new_groups) % self.capacity] = vectors
+        return expanded
+
+    def stats(self):
+        return {
+            'texts': self.texts,
+            'duplicates': self.duplicates,
+            'groups': self.next_group,
+            'groups_with_copies': self.groups_with_copies,
+            'threshold': self.threshold,
+        }
+
+    def summary(self):
+        share = self.duplicates / self.texts if self.texts else 0.0
+        return (f"Near-duplicates: {self.duplicates} of {self.texts} texts ({share:.1%}) reused the vector of an "
+                f"earlier copy; {self.groups_with_copies} of {self.next_group} groups have copies")
@@ -0,0 +1,91 @@
+'''
+ONNX Runtime backend for generate_embeddings.py.
+
+The first time a model is requested, it is exported to ONNX through sentence-transformers and
+dynamically quantized to int8, and the result is saved under ONNX_CACHE_DIR. Later runs (and
+every --workers process) load the cached artifact directly. The returned model is an ordinary
+SentenceTransformer, so model.encode() and everything built on it work unchanged.
+
+Needs the optional ONNX extras: pip install "sentence-transformers[onnx]"
+'''
+import os
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+ONNX_CACHE_DIR = 'onnx_models'
+# Instruction set to tune the int8 quantization for. avx2 runs everywhere on x86; avx512_vnni
+# is faster on recent Xeons, arm64 is for Graviton and friends. 'none' keeps float32 weights.
+QUANTIZATION_CONFIGS = ['avx2', 'avx512', 'avx512_vnni', 'arm64', 'none']
+
+
+def onnx_model_dir(model_name, cache_dir=ONNX_CACHE_DIR):
+    return os.path.join(cache_dir, model_name.replace('/', '__'))
+
+
+def find_onnx_file(model_dir, quantization):
+    """
+    Returns the path of the exported ONNX file relative to model_dir, or None if there isn't one.
+    """
+    # The exact name sentence-transformers saves the export under, since one quantization's name
+    # can be part of another's (avx512 and avx512_vnni)
+    name = 'model.onnx' if quantization == 'none' else f'model_qint8_{quantization}.onnx'
+    path = os.path.join(model_dir, 'onnx', name)
+    if not os.path.exists(path):
+        return None
+    return os.path.relpath(path, model_dir)
+
+
+def export_onnx_model(model_name, quantization, cache_dir=ONNX_CACHE_DIR):
+    """
+    Exports model_name to ONNX, quantizes it, and saves both under cache_dir.
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model_dir = onnx_model_dir(model_name, cache_dir)
+    print(f"Exporting '{model_name}' to ONNX in {model_dir} (one-off)...")
+    model = SentenceTransformer(model_name, device='cpu', backend='onnx')
+    model.save_pretrained(model_dir)
+    if quantization != 'none':
+        print(f"Quantizing to int8 for {quantization}...")
+        export_dynamic_quantized_onnx_model(model, quantization, model_dir)
+    return model_dir
+
+
+def load_onnx_model(model_name, quantization, threads=None, cache_dir=ONNX_CACHE_DIR):
+    """
+    Loads the cached ONNX export of model_name, exporting it first if needed.
+    threads caps ONNX Runtime's intra-op thread pool, as torch.set_num_threads does for torch.
+    """
+    model_dir = onnx_model_dir(model_name, cache_dir)
+    file_name = find_onnx_file(model_dir, quantization)
+    if file_name is None:
+        export_onnx_model(model_name, quantization, cache_dir)
+        file_name = find_onnx_file(model_dir, quantization)
+        if file_name is None:
+            raise RuntimeError(f"ONNX export of '{model_name}' did not produce a {quantization} model in {model_dir}")
+
+    model_kwargs = {'file_name': file_name, 'provider': 'CPUExecutionProvider'}
+    if threads:
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        model_kwargs['session_options'] = session_options
+    print(f"Loading ONNX model {os.path.join(model_dir, file_name)}...")
+    return SentenceTransformer(model_dir, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+
+
+def parity_check(onnx_model, model_name, texts, device):
+    """
+    Encodes texts with both the ONNX model and the original torch model, and returns the
+    largest and mean cosine deviation (1 - cosine similarity) between the two.
+    """
+    torch_model = SentenceTransformer(model_name, device=device)
+    expected = torch_model.encode(texts, show_progress_bar=False, device=device, batch_size=32)
+    actual = onnx_model.encode(texts, show_progress_bar=False, batch_size=32)
+    del torch_model
+
+    expected = expected / np.linalg.norm(expected, axis=1, keepdims=True)
+    actual = actual / np.linalg.norm(actual, axis=1, keepdims=True)
+    deviation = 1.0 - np.sum(expected * actual, axis=1)
+    return float(deviation.max()), float(deviation.mean())
@@ -0,0 +1,169 @@
+'''
+A local stand-in for the parts of the OpenSearch REST API that opensearch_sink.py uses, to try
+generate_embeddings.py --output-format opensearch without running OpenSearch:
+
+    python opensearch_standin.py --port 9201 --latency 0.2 --reject-rate 0.05
+    python generate_embeddings.py --output-format opensearch --opensearch-url http://localhost:9201
+
+It accepts index creation, bulk index requests, refreshes and counts, and keeps only the ids of
+the documents, checking that each one has a vector of the index's dimension. --latency makes
+every bulk request take that long, to see requests overlap, and --reject-rate rejects that share
+of documents with a 429 the way a node with a full write queue does, to exercise the retries.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VECTOR_FIELD = 'full_text_vector'
+
+
+class StandInState:
+    def __init__(self, latency=0.0, reject_rate=0.0, seed=0):
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.indices = {} # name -> {'dim': vector dimension or None, 'ids': set(), 'auto_ids': count}
+        self.bulk_requests = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def index_documents(self, body):
+        """
+        Applies a bulk request body and returns the bulk API response.
+        """
+        lines = body.decode('utf-8').split('\n')
+        items = []
+        for action_line, document_line in zip(lines[0::2], lines[1::2]):
+            action = json.loads(action_line)['index']
+            document = json.loads(document_line)
+            with self.lock:
+                index = self.indices.setdefault(action['_index'], {'dim': None, 'ids': set(), 'auto_ids': 0})
+                reject = self.random.random() < self.reject_rate
+                vector = document.get(VECTOR_FIELD)
+                if reject:
+                    self.rejected += 1
+                    items.append({'index': {'_index': action['_index'], '_id': action.get('_id'), 'status': 429,
+                                            'error': {'type': 'es_rejected_execution_exception',
+                                                      'reason': 'rejected execution (stand-in)'}}})
+                elif index['dim'] is not None and (not isinstance(vector, list) or len(vector) != index['dim']):
+                    items.append({'index': {'_index': action['_index'], '_id': action.get('_id'), 'status': 400,
+                                            'error': {'type': 'mapper_parsing_exception',
+                                                      'reason': f"Vector dimension mismatch. Expected: {index['dim']}"}}})
+                else:
+                    if '_id' in action:
+                        created = action['_id'] not in index['ids']
+                        index['ids'].add(action['_id'])
+                    else:
+                        created = True
+                        index['auto_ids'] += 1
+                    items.append({'index': {'_index': action['_index'], '_id': action.get('_id'),
+                                            'status': 201 if created else 200,
+                                            'result': 'created' if created else 'updated'}})
+        errors = any('error' in item['index'] for item in items)
+        return {'took': int(self.latency * 1000), 'errors': errors, 'items': items}
+
+    def count(self, name):
+        index = self.indices[name]
+        return len(index['ids']) + index['auto_ids']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like OpenSearch
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def path_parts(self):
+        return [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(self.path).path.split('/') if part]
+
+    def do_HEAD(self):
+        parts = self.path_parts()
+        self.send_json(200 if len(parts) == 1 and parts[0] in self.state.indices else 404)
+
+    def do_PUT(self):
+        parts = self.path_parts()
+        body = json.loads(self.read_body() or b'{}')
+        if len(parts) != 1:
+            return self.send_json(400, {'error': 'unsupported'})
+        with self.state.lock:
+            if parts[0] in self.state.indices:
+                return self.send_json(400, {'error': {'type': 'resource_already_exists_exception'}, 'status': 400})
+            vector = body.get('mappings', {}).get('properties', {}).get(VECTOR_FIELD, {})
+            self.state.indices[parts[0]] = {'dim': vector.get('dimension'), 'ids': set(), 'auto_ids': 0}
+        self.send_json(200, {'acknowledged': True, 'index': parts[0]})
+
+    def do_POST(self):
+        parts = self.path_parts()
+        body = self.read_body()
+        if parts == ['_bulk']:
+            state = self.state
+            with state.lock:
+                state.bulk_requests += 1
+                state.in_flight += 1
+                state.max_in_flight = max(state.max_in_flight, state.in_flight)
+            try:
+                time.sleep(state.latency)
+                response = state.index_documents(body)
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+            return self.send_json(200, response)
+        if len(parts) == 2 and parts[1] == '_refresh':
+            return self.send_json(200, {'_shards': {'failed': 0}})
+        self.send_json(400, {'error': 'unsupported'})
+
+    def do_GET(self):
+        parts = self.path_parts()
+        if parts == ['_cluster', 'health']:
+            return self.send_json(200, {'status': 'green', 'number_of_nodes': 1})
+        if len(parts) == 2 and parts[1] == '_count' and parts[0] in self.state.indices:
+            return self.send_json(200, {'count': self.state.count(parts[0])})
+        self.send_json(404, {'error': 'not found'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the OpenSearch bulk API.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9201)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every bulk request takes')
+    parser.add_argument('--reject-rate', type=float, default=0.0,
+                        help='Share of documents rejected with a 429, as by a full write queue')
+    args = parser.parse_args()
+
+    StandInHandler.state = StandInState(args.latency, args.reject_rate)
+    server = ThreadingHTTPServer((args.host, args.port), StandInHandler)
+    print(f"OpenSearch stand-in listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        state = StandInHandler.state
+        print(f"{state.bulk_requests} bulk requests (at most {state.max_in_flight} at once), "
+              f"{state.rejected} documents rejected")
+        for name in state.indices:
+            print(f"{name}: {state.count(name)} documents")
+
+
+if __name__ == '__main__':
+    main()
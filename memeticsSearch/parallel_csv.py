@@ -0,0 +1,209 @@
+'''
+Parallel reading of large CSV files like post.csv, for generate_embeddings.py --read-workers and
+for analyses (term counts and the like) that need to stream every row.
+
+The file is cut into byte ranges of about RANGE_BYTES. A range can start in the middle of a
+quoted full_text that spans several lines, so each cut is moved forward to the next real record
+boundary: the number of '"' characters before the cut says whether it falls inside quotes
+(escaped quotes are doubled, so they don't change the parity), and from there the first newline
+outside quotes ends the record. The quote counts are taken in parallel, then every range is
+parsed by csv.reader in a worker process, and the ranges are handed back in file order, so row
+numbers are the same as a sequential read.
+
+This relies on quotes only appearing in quoted fields, as in any RFC 4180 CSV (post.csv is
+written that way); a stray quote inside an unquoted field would throw the parity off.
+
+For an analysis:
+
+    with ParallelCSVReader('post.csv', workers=8, columns=['created_at', 'full_text']) as reader:
+        for row_number, (created_at, full_text) in reader.rows():
+            ...
+'''
+import csv
+import io
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Bytes per range handed to a worker. Large enough that the per-task overhead is noise, small
+# enough that only a few ranges of parsed rows are held in memory at a time.
+RANGE_BYTES = 32 * 1024 * 1024
+# Ranges parsed ahead of the consumer, per worker
+PREFETCH_PER_WORKER = 2
+BLOCK_SIZE = 1024 * 1024
+
+
+class OffsetLineReader:
+    """
+    Iterates over the decoded lines of a binary file while keeping track of the byte offset
+    just past the last line handed out. csv.reader pulls lines only as it needs them, so once
+    it yields a record the offset points exactly at the start of the next record, even when a
+    quoted field spans several lines.
+    """
+    def __init__(self, binary_file, encoding='utf-8', offset=None):
+        self.file = binary_file
+        self.encoding = encoding
+        self.offset = binary_file.tell() if offset is None else offset
+
+    def __iter__(self):
+        for raw_line in self.file:
+            self.offset += len(raw_line)
+            yield raw_line.decode(self.encoding)
+
+
+def read_header(path):
+    """
+    Returns the header row of the CSV and the byte offset of the first record after it.
+    """
+    with open(path, 'rb') as f:
+        lines = OffsetLineReader(f)
+        header = next(csv.reader(lines), None)
+        return header, lines.offset
+
+
+def count_quotes(path, start, end):
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            count += block.count(b'"')
+            remaining -= len(block)
+    return count
+
+
+def next_record_start(path, offset, in_quotes):
+    """
+    Returns the offset of the first record that starts at or after offset, given whether
+    offset falls inside a quoted field.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        position = offset
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                return position
+            start = 0
+            while True:
+                newline = block.find(b'\n', start)
+                end = len(block) if newline < 0 else newline
+                if block.count(b'"', start, end) % 2:
+                    in_quotes = not in_quotes
+                if newline < 0:
+                    break
+                if not in_quotes:
+                    return position + newline + 1
+                start = newline + 1
+            position += len(block)
+
+
+def plan_ranges(path, start, range_bytes=RANGE_BYTES, executor=None):
+    """
+    Splits the file from start (a record boundary) to the end into (start, end) byte ranges
+    that each begin and end on a record boundary.
+    """
+    size = os.path.getsize(path)
+    cuts = list(range(start, size, range_bytes)) + [size]
+    if len(cuts) <= 2:
+        return [(start, size)] if start < size else []
+    run = executor.map if executor is not None else map
+
+    counts = list(run(count_quotes, [path] * (len(cuts) - 1), cuts[:-1], cuts[1:]))
+    parities = []
+    total = 0
+    for count in counts[:-1]:
+        total += count
+        parities.append(total % 2 == 1)
+    aligned = list(run(next_record_start, [path] * len(parities), cuts[1:-1], parities))
+
+    bounds = [start] + aligned + [size]
+    return [(begin, end) for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+
+
+def parse_range(path, start, end, keep=None, width=None):
+    """
+    Parses the records in [start, end). Returns the rows, as lists of the fields at the keep
+    indices (all fields if None), and the byte offset just past each row. Rows shorter than
+    width are padded with empty strings.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = OffsetLineReader(io.BytesIO(data), offset=start)
+    rows = []
+    offsets = []
+    for values in csv.reader(lines):
+        if width is not None and len(values) < width:
+            values += [''] * (width - len(values))
+        rows.append(values if keep is None else [values[i] for i in keep])
+        offsets.append(lines.offset)
+    return rows, offsets
+
+
+class ParallelCSVReader:
+    """
+    Streams the records of a CSV file, parsed in worker processes, in file order.
+    """
+    def __init__(self, path, workers=None, start=None, columns=None, range_bytes=RANGE_BYTES):
+        """
+        start is the byte offset of a record to begin from (by default the one after the
+        header). columns limits each row to those header fields, in that order, so only they
+        are sent back from the workers.
+        """
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.range_bytes = range_bytes
+        self.fieldnames, header_end = read_header(path)
+        self.start = header_end if start is None else start
+        self.width = len(self.fieldnames) if self.fieldnames else None
+        self.keep = None
+        if columns is not None:
+            missing = [column for column in columns if column not in self.fieldnames]
+            if missing:
+                raise ValueError(f"Columns not in the CSV header: {', '.join(missing)}")
+            self.keep = [self.fieldnames.index(column) for column in columns]
+        # spawn rather than fork, since the parent may already be running torch's thread pools
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    def ranges(self):
+        """
+        Yields (rows, offsets) for each byte range, in file order, while later ranges are
+        being parsed.
+        """
+        ranges = plan_ranges(self.path, self.start, self.range_bytes, self.executor)
+        pending = deque()
+        for begin, end in ranges:
+            pending.append(self.executor.submit(parse_range, self.path, begin, end, self.keep, self.width))
+            if len(pending) >= self.workers * PREFETCH_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def records(self):
+        """
+        Yields (values, end_offset) for every record.
+        """
+        for rows, offsets in self.ranges():
+            yield from zip(rows, offsets)
+
+    def rows(self, first_row=1):
+        """
+        Yields (row_number, values) for every record, numbering data rows from first_row.
+        """
+        for row_number, (values, _) in enumerate(self.records(), start=first_row):
+            yield row_number, values
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
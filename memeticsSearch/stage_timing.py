@@ -0,0 +1,169 @@
+'''
+Per-stage timing for generate_embeddings.py, so a slow run can be traced to the stage that
+needs the hardware: CSV parsing, text validation and normalization, --dedup
+near-duplicate matching, tokenization, the model's forward pass,
+--reduce-dim projection, serialization, or disk writes.
+
+Stages are timed where they run and accumulated in a StageTimer, which prints a one-line
+summary every few seconds and produces a JSON report at the end. Tokenization is measured by
+wrapping the model's tokenize method, which SentenceTransformer.encode calls once per
+sub-batch; the rest of each encode call is counted as the forward pass. With --workers, the
+tokenize and forward times are summed over the worker processes, so they can add up to more
+than the wall-clock time.
+'''
+import contextlib
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+STAGES = ['csv_parse', 'validate', 'normalize', 'dedup', 'tokenize', 'forward', 'project', 'serialize', 'disk_write']
+
+
+def peak_rss_bytes():
+    """
+    The peak resident set size of this process so far, or None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def timed(timer, stage):
+    """
+    Times a with block as stage on timer, or does nothing if timer is None.
+    """
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.stage(stage)
+
+
+class StageTimer:
+    """
+    Accumulates seconds per stage and counts of rows and tokens. Safe to use from the
+    threads of a --pipeline run.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.calls = {stage: 0 for stage in STAGES}
+        self.rows = 0
+        self.texts = 0
+        self.tokens = 0
+        self.worker_peak_rss = {} # pid -> bytes, with --workers
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.last_report = self.started
+
+    def restart_clock(self):
+        """
+        Restarts the elapsed time that rates are measured over, keeping everything recorded so far.
+        """
+        self.started = self.last_report = time.perf_counter()
+
+    def add(self, stage, seconds, calls=1):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def count(self, rows=0, texts=0, tokens=0):
+        with self.lock:
+            self.rows += rows
+            self.texts += texts
+            self.tokens += tokens
+
+    def instrument_model(self, model):
+        """
+        Wraps model.tokenize so every call is timed as tokenization and its real (unpadded)
+        tokens are counted.
+        """
+        tokenize = getattr(model, 'tokenize', None)
+        if tokenize is None:
+            return
+
+        def timed_tokenize(texts, *args, **kwargs):
+            start = time.perf_counter()
+            features = tokenize(texts, *args, **kwargs)
+            self.add('tokenize', time.perf_counter() - start)
+            mask = features.get('attention_mask') if isinstance(features, dict) else None
+            if mask is not None:
+                self.count(tokens=int(mask.sum()))
+            return features
+
+        model.tokenize = timed_tokenize
+
+    def encode_started(self):
+        """
+        Returns a token for encode_finished, which counts everything in between that wasn't
+        tokenization as the forward pass.
+        """
+        return time.perf_counter(), self.seconds['tokenize']
+
+    def encode_finished(self, started, num_texts):
+        start, tokenize_before = started
+        elapsed = time.perf_counter() - start
+        tokenize_seconds = self.seconds['tokenize'] - tokenize_before
+        self.add('forward', max(0.0, elapsed - tokenize_seconds))
+        self.count(texts=num_texts)
+
+    def maybe_report(self):
+        """
+        Prints a progress line if at least interval seconds have passed since the last one.
+        """
+        now = time.perf_counter()
+        if not self.interval or now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        print(self.progress_line())
+
+    def progress_line(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        stages = ' '.join(f"{stage} {self.seconds[stage]:.1f}s" for stage in STAGES)
+        peak = peak_rss_bytes()
+        rss = f" | peak RSS {peak / 1e9:.2f} GB" if peak is not None else ''
+        return (f"[stats] {self.rows} rows in {elapsed:.0f}s, {self.rows / elapsed:.1f} rows/s, "
+                f"{self.tokens / elapsed:.0f} tokens/s | {stages}{rss}")
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'elapsed_seconds': elapsed,
+            'rows': self.rows,
+            'texts_encoded': self.texts,
+            'tokens': self.tokens,
+            'rows_per_second': self.rows / elapsed if elapsed else 0.0,
+            'tokens_per_second': self.tokens / elapsed if elapsed else 0.0,
+            'stages': {
+                stage: {
+                    'seconds': self.seconds[stage],
+                    'calls': self.calls[stage],
+                    'share': self.seconds[stage] / elapsed if elapsed else 0.0,
+                }
+                for stage in STAGES
+            },
+            'peak_rss_bytes': peak_rss_bytes(),
+            'worker_peak_rss_bytes': max(self.worker_peak_rss.values(), default=None),
+        }
+
+    def save(self, path, extra=None):
+        report = self.report()
+        if extra:
+            report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
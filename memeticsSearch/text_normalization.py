@@ -0,0 +1,98 @@
+'''
+Text normalization for generate_embeddings.py --normalize-text.
+
+Tweets carry a lot of tokens that mean nothing to a sentence embedding: t.co links, the chain
+of @mentions Twitter prefixes to every reply, HTML entities like &amp; left over from the
+archive export, and runs of blank lines. Removing them before encoding makes every forward pass
+cheaper, and makes copies of the same text that differ only in those parts identical, so the
+embedding cache (see embedding_cache.py) serves them.
+
+Only the text given to the model is normalized; the output keeps the original full_text.
+
+The regular expressions run once over the whole batch joined into a single string, rather than
+once per tweet, which keeps the per-call overhead out of the loop.
+'''
+import html
+import re
+
+SEPARATOR = '\x00'
+URL_PATTERN = re.compile(r'https?://[^\s\x00]+')
+# One or more @handles at the very start of a text, i.e. of the string or right after a separator
+MENTION_PREFIX_PATTERN = re.compile(r'(?<![^\x00])\s*(?:@\w{1,15}(?:\s+|(?=\x00)|\Z))+')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+# Every this many changed texts, one is tokenized before and after to estimate the tokens removed
+TOKEN_SAMPLE_EVERY = 20
+
+
+def normalize_texts(texts):
+    """
+    Returns texts with HTML entities unescaped, URLs and leading @mention chains removed
+    and whitespace collapsed. A text that would be left empty (a bare link, say) is
+    returned with only its entities and whitespace normalized.
+    """
+    if not texts:
+        return []
+    joined = html.unescape(SEPARATOR.join(text.replace(SEPARATOR, ' ') for text in texts))
+    stripped = MENTION_PREFIX_PATTERN.sub('', URL_PATTERN.sub('', joined))
+    stripped = WHITESPACE_PATTERN.sub(' ', stripped).split(SEPARATOR)
+    unescaped = WHITESPACE_PATTERN.sub(' ', joined).split(SEPARATOR)
+    return [text.strip() or fallback.strip() for text, fallback in zip(stripped, unescaped)]
+
+
+class TextNormalizer:
+    """
+    Normalizes batches of texts and keeps count of how much it saved. With a tokenizer, the
+    savings are also estimated in real tokens: one in TOKEN_SAMPLE_EVERY changed texts is
+    tokenized before and after, and its tokens per removed character are scaled up to all the
+    characters removed, so the statistic doesn't cost a tokenization pass of its own.
+    """
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.texts = 0
+        self.changed = 0
+        self.chars_before = 0
+        self.chars_after = 0
+        self.sampled_chars_removed = 0
+        self.sampled_tokens_removed = 0
+
+    def normalize(self, texts):
+        normalized = normalize_texts(texts)
+        changed = [i for i, (before, after) in enumerate(zip(texts, normalized)) if before != after]
+        # Continue the sampling stride across batches
+        sampled = changed[-self.changed % TOKEN_SAMPLE_EVERY::TOKEN_SAMPLE_EVERY]
+        self.texts += len(texts)
+        self.changed += len(changed)
+        self.chars_before += sum(len(text) for text in texts)
+        self.chars_after += sum(len(text) for text in normalized)
+        if self.tokenizer is not None and sampled:
+            before, after = [texts[i] for i in sampled], [normalized[i] for i in sampled]
+            self.sampled_chars_removed += sum(len(text) for text in before) - sum(len(text) for text in after)
+            self.sampled_tokens_removed += self._count_tokens(before) - self._count_tokens(after)
+        return normalized
+
+    @property
+    def tokens_removed(self):
+        if self.tokenizer is None:
+            return None
+        if not self.sampled_chars_removed:
+            return self.sampled_tokens_removed
+        return round(self.sampled_tokens_removed / self.sampled_chars_removed * (self.chars_before - self.chars_after))
+
+    def _count_tokens(self, texts):
+        encoded = self.tokenizer(texts, add_special_tokens=False, truncation=False)
+        return sum(len(ids) for ids in encoded['input_ids'])
+
+    def stats(self):
+        return {
+            'texts': self.texts,
+            'texts_changed': self.changed,
+            'chars_before': self.chars_before,
+            'chars_after': self.chars_after,
+            'tokens_removed': self.tokens_removed, # Estimated from a sample
+        }
+
+    def summary(self):
+        saved = 1 - self.chars_after / self.chars_before if self.chars_before else 0.0
+        tokens = f", about {self.tokens_removed} tokens" if self.tokenizer is not None else ''
+        return (f"Normalization: {self.changed} of {self.texts} texts changed, "
+                f"{self.chars_before - self.chars_after} characters ({saved:.1%}){tokens} removed before encoding")
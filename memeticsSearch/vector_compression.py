@@ -0,0 +1,170 @@
+'''
+Lossy compression of embedding vectors for generate_embeddings.py, and the recall@k measurement
+used to check how much search quality it costs.
+
+Per-dimension int8 scalar quantization maps each dimension's [min, max] range, as seen on a
+calibration sample, onto the 256 int8 values. The parameters are saved as JSON next to the
+output so readers can dequantize with:
+
+    vectors = (codes.astype(np.float32) + 128) * scale + min
+
+PCA projection keeps the top principal components of a calibration sample, so 384-dimension
+vectors can be stored as, say, 128. The covariance is accumulated over chunks of the sample and
+the components taken from it at the end. The projection is saved as JSON too, and queries have
+to go through it before searching the reduced vectors:
+
+    reduced = (vectors - mean) @ components.T   # then divided by its norm if normalize is set
+'''
+import json
+
+import numpy as np
+
+QUANTIZATION_SUFFIX = '.quant.json'
+PROJECTION_SUFFIX = '.pca.json'
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension min/scale int8 quantization. Values outside the calibrated range are clipped.
+    """
+    def __init__(self, minimum, scale):
+        self.min = np.asarray(minimum, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, vectors):
+        minimum = vectors.min(axis=0)
+        maximum = vectors.max(axis=0)
+        # Guard against constant dimensions, which would otherwise divide by zero
+        scale = np.maximum(maximum - minimum, 1e-12) / 255.0
+        return cls(minimum, scale)
+
+    def quantize(self, vectors):
+        codes = np.rint((vectors - self.min) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def dequantize(self, codes):
+        return (codes.astype(np.float32) + 128) * self.scale + self.min
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'scheme': 'int8-per-dimension-minmax',
+                'dequantize': '(code + 128) * scale + min',
+                'dim': len(self.min),
+                'min': self.min.tolist(),
+                'scale': self.scale.tolist(),
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            params = json.load(f)
+        return cls(params['min'], params['scale'])
+
+
+class PcaProjection:
+    """
+    Projects vectors onto their top principal components. If the vectors it was fit on had
+    unit length, as sentence-transformers models normalize them, the projected ones are
+    normalized again so that cosine and L2 searches still agree.
+    """
+    def __init__(self, mean, components, normalize=False, explained_variance=None):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.normalize = normalize
+        self.explained_variance = explained_variance
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, chunks, dim):
+        """
+        Fits the projection to dim dimensions on an iterable of (rows, input dim) chunks.
+        """
+        count = 0
+        total = None
+        scatter = None
+        unit_length = True
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            if total is None:
+                total = np.zeros(chunk.shape[1])
+                scatter = np.zeros((chunk.shape[1], chunk.shape[1]))
+            count += len(chunk)
+            total += chunk.sum(axis=0)
+            scatter += chunk.T @ chunk
+            unit_length = unit_length and np.allclose(np.linalg.norm(chunk, axis=1), 1.0, atol=1e-3)
+        if total is None or dim >= len(total):
+            raise ValueError(f"Can only reduce to fewer dimensions than the {0 if total is None else len(total)} "
+                             f"the vectors have, not {dim}")
+        if count <= dim:
+            raise ValueError(f"Need more than {dim} vectors to fit a {dim}-dimension projection, got {count}")
+
+        mean = total / count
+        covariance = (scatter - count * np.outer(mean, mean)) / (count - 1)
+        variances, vectors = np.linalg.eigh(covariance) # Ascending order
+        components = vectors[:, ::-1][:, :dim].T
+        # Fix the sign of each component, so refitting on the same data gives the same output
+        signs = np.sign(components[np.arange(dim), np.abs(components).argmax(axis=1)])
+        components *= signs[:, None]
+        explained = float(variances[::-1][:dim].sum() / max(variances.sum(), 1e-12))
+        return cls(mean, components, unit_length, explained)
+
+    def project(self, vectors):
+        projected = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+        if self.normalize and len(projected):
+            projected /= np.maximum(np.linalg.norm(projected, axis=1, keepdims=True), 1e-12)
+        return projected
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'scheme': 'pca',
+                'project': '(vector - mean) @ components.T, divided by its norm if normalize',
+                'input_dim': len(self.mean),
+                'dim': self.dim,
+                'normalize': self.normalize,
+                'explained_variance': self.explained_variance,
+                'mean': self.mean.tolist(),
+                'components': self.components.tolist(),
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            params = json.load(f)
+        return cls(params['mean'], params['components'], params['normalize'], params.get('explained_variance'))
+
+
+def reduce_precision(vectors, vector_dtype, quantizer=None):
+    """
+    Round-trips vectors through vector_dtype, returning what a reader of the output will see.
+    """
+    if vector_dtype == 'int8':
+        return quantizer.dequantize(quantizer.quantize(vectors))
+    return vectors.astype(vector_dtype).astype(np.float32)
+
+
+def top_k(queries, corpus, k):
+    """
+    Returns the indices of the k most cosine-similar corpus vectors for each query.
+    """
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    corpus = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+    scores = queries @ corpus.T
+    k = min(k, corpus.shape[0])
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def recall_at_k(queries, corpus, approx_queries, approx_corpus, k=10):
+    """
+    Fraction of each query's true top-k neighbours (by full-precision vectors) that are
+    still in its top-k when searching with the approximate vectors, averaged over queries.
+    """
+    exact = top_k(queries, corpus, k)
+    approx = top_k(approx_queries, approx_corpus, k)
+    hits = [len(set(e) & set(a)) for e, a in zip(exact, approx)]
+    return float(np.mean(hits)) / exact.shape[1]
@@ -0,0 +1,493 @@
+'''
+Output formats for generate_embeddings.py.
+
+Every writer takes the rows of a batch together with their embeddings, and reports its position
+through state() so the run's checkpoint can record it. When resuming, the writer is handed that
+state back and truncates anything written after it.
+
+- jsonl: one JSON record per row with the vector inlined as full_text_vector. This is what
+  ingest_jsonl.ts reads. With float16, values are rounded to float16 precision and written
+  with 5 significant digits instead of the ~18 needed for a float64. Whole batches are
+  serialized at once (see write_batch), using orjson when it is installed.
+- npy:   vectors go into a contiguous float32/float16/int8 .npy file that can be memory-mapped
+  with np.load(path, mmap_mode='r'), and the rest of each row goes into a JSONL sidecar
+  (<output>.meta.jsonl) whose line i describes vector i. int8 vectors are per-dimension
+  scalar quantized; the parameters are in <output>.quant.json (see vector_compression.py).
+
+Either format can be split into numbered shards by ShardedWriter, which also maintains a
+manifest describing every finished shard so ingestion can be fanned out and retried per shard.
+
+Writers given a StageTimer (see stage_timing.py) record serialization and disk writes separately.
+'''
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+from stage_timing import timed
+
+try:
+    import orjson # Optional, several times faster than json for both records and vectors
+except ImportError:
+    orjson = None
+
+from vector_compression import QUANTIZATION_SUFFIX
+
+# Space reserved for the .npy header so it can be rewritten in place as the row count grows.
+# The header dict is well under 100 bytes even for billions of rows.
+NPY_HEADER_SIZE = 128
+NPY_METADATA_SUFFIX = '.meta.jsonl'
+
+
+def format_vectors(embeddings, decimals):
+    """
+    Formats each row of embeddings as a JSON array of fixed-point numbers with the given
+    number of decimals. The text for the whole matrix is built with numpy arithmetic on a
+    character array, so there is no per-element string formatting. Every number is padded to
+    the same width (a leading space stands in for the minus sign, which JSON allows).
+
+    Returns None if any value needs more than one integer digit; callers then fall back to
+    the general path. Sentence embeddings are almost always within (-10, 10).
+    """
+    if embeddings.size == 0:
+        return ['[]'] * len(embeddings)
+    factor = 10 ** decimals
+    scaled = np.rint(np.abs(embeddings.astype(np.float64)) * factor).astype(np.int64)
+    if not np.isfinite(embeddings).all() or scaled.max() >= 10 * factor:
+        return None
+
+    rows, dim = embeddings.shape
+    width = decimals + 4 # sign, integer digit, point, decimals, comma
+    chars = np.empty((rows, dim, width), dtype=np.uint8)
+    chars[:, :, 0] = np.where((embeddings < 0) & (scaled > 0), ord('-'), ord(' '))
+    chars[:, :, 1] = scaled // factor + ord('0')
+    chars[:, :, 2] = ord('.')
+    fraction = scaled % factor
+    for digit in range(decimals):
+        chars[:, :, 3 + digit] = (fraction // 10 ** (decimals - 1 - digit)) % 10 + ord('0')
+    chars[:, :, -1] = ord(',')
+    chars[:, -1, -1] = ord(']')
+
+    text = chars.reshape(rows, dim * width)
+    return ['[' + row.tobytes().decode('ascii') for row in text]
+
+
+def serialize_vectors(embeddings, vector_dtype='float32', decimals=None):
+    """
+    Returns the JSON array text for every row of embeddings, serializing the whole matrix in
+    one call and splitting it into rows, rather than calling the encoder once per row.
+    """
+    if decimals is not None:
+        formatted = format_vectors(embeddings, decimals)
+        if formatted is not None:
+            return formatted
+    if len(embeddings) == 0:
+        return []
+
+    if vector_dtype == 'float16':
+        # 5 significant digits are enough to round-trip any float16
+        return ['[' + ','.join(f'{value:.5g}' for value in row) + ']'
+                for row in embeddings.astype(np.float16).tolist()]
+    if orjson is not None:
+        text = orjson.dumps(np.ascontiguousarray(embeddings), option=orjson.OPT_SERIALIZE_NUMPY).decode('ascii')
+        separator = '],['
+    else:
+        text = json.dumps(embeddings.tolist())
+        separator = '], ['
+    # Strip the outer "[[" and "]]" and split the matrix back into its rows
+    return ['[' + row + ']' for row in text[2:-2].split(separator)]
+
+
+# Match the encoder's own separators so spliced-in vectors look like the rest of the line
+FIELD_SEPARATOR, KEY_SEPARATOR = (',', ':') if orjson is not None else (', ', ': ')
+
+
+def dumps_record(record):
+    if orjson is not None:
+        return orjson.dumps(record).decode('utf-8')
+    return json.dumps(record)
+
+
+def as_records(rows, columns=None):
+    """
+    Yields each row as a dict. Rows are either dicts already or, with columns, tuples of values.
+    """
+    if columns is None:
+        return iter(rows)
+    return (dict(zip(columns, row)) for row in rows)
+
+
+def write_batch(batch, embeddings, jsonlfile, vector_dtype='float32', decimals=None, columns=None):
+    """
+    Adds the embeddings to the records and writes them to the JSONL file in a single write
+    (see format_batch).
+    """
+    jsonlfile.write(format_batch(batch, embeddings, vector_dtype, decimals, columns))
+
+
+def format_batch(batch, embeddings, vector_dtype='float32', decimals=None, columns=None):
+    """
+    Returns the JSONL lines for the records with their embeddings added.
+
+    The vectors for the whole batch are serialized together, and each record's JSON gets its
+    vector spliced in as the last field. Records can be dicts, or tuples of values for the
+    given columns.
+    """
+    try:
+        vectors = serialize_vectors(embeddings, vector_dtype, decimals)
+    except Exception as e:
+        print(f"Error serializing embeddings of shape {embeddings.shape}: {e}")
+        raise
+
+    lines = []
+    for i, record in enumerate(as_records(batch, columns)):
+        try:
+            json_record = dumps_record(record)
+            separator = FIELD_SEPARATOR if len(json_record) > 2 else ''
+            lines.append(f'{json_record[:-1]}{separator}"full_text_vector"{KEY_SEPARATOR}{vectors[i]}}}\n')
+        except Exception as e:
+            print(f"Error processing record {i}: {e}")
+            print(f"Record: {record}")
+            print(f"Embedding shape: {embeddings[i].shape if i < len(embeddings) else 'N/A'}")
+            raise
+    return ''.join(lines)
+
+
+def truncate_to(path, size):
+    """
+    Cuts path back to size bytes, dropping anything written after the last checkpoint.
+    """
+    current_size = os.path.getsize(path)
+    if current_size < size:
+        raise RuntimeError(f"{path} is shorter ({current_size} bytes) than the checkpoint "
+                           f"records ({size} bytes); cannot resume")
+    if current_size > size:
+        print(f"Truncating {current_size - size} bytes written to {path} after the last checkpoint")
+        os.truncate(path, size)
+
+
+class JsonlWriter:
+    """
+    Writes each row as a JSON line with its vector inlined.
+    """
+    def __init__(self, path, dim, resume_state=None, vector_dtype='float32', decimals=None, timer=None):
+        if vector_dtype not in ('float32', 'float16'):
+            raise ValueError(f"JSONL output supports float32 and float16 vectors, not {vector_dtype}")
+        self.path = path
+        self.paths = [path]
+        self.vector_dtype = vector_dtype
+        self.decimals = decimals
+        self.timer = timer
+        if resume_state is not None:
+            if resume_state.get('vector_dtype', 'float32') != vector_dtype:
+                raise RuntimeError(f"Checkpoint was written with {resume_state.get('vector_dtype')} "
+                                   f"vectors, not {vector_dtype}; cannot resume")
+            truncate_to(path, resume_state['output_offset'])
+        # orjson writes raw UTF-8, and output_offset is a byte offset into it whatever the locale
+        self.file = open(path, 'a' if resume_state is not None else 'w', encoding='utf-8')
+
+    def write(self, rows, embeddings, row_numbers=None, columns=None):
+        with timed(self.timer, 'serialize'):
+            text = format_batch(rows, embeddings, self.vector_dtype, self.decimals, columns)
+        with timed(self.timer, 'disk_write'):
+            self.file.write(text)
+
+    def state(self):
+        self.file.flush()
+        return {'output_offset': self.file.tell(), 'vector_dtype': self.vector_dtype}
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        self.close()
+
+
+def npy_header(dtype, count, dim):
+    """
+    Builds a version 1.0 .npy header for a (count, dim) C-order array, padded to NPY_HEADER_SIZE.
+    """
+    header = repr({
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': (count, dim),
+    }).encode('latin1')
+    prefix = b'\x93NUMPY\x01\x00'
+    padding = NPY_HEADER_SIZE - len(prefix) - 2 - len(header) - 1
+    return prefix + struct.pack('<H', len(header) + padding + 1) + header + b' ' * padding + b'\n'
+
+
+class NpyWriter:
+    """
+    Appends vectors to a .npy file and the remaining columns to an aligned JSONL sidecar.
+
+    The .npy header is rewritten with the current row count on every state() call, so the file
+    is loadable (and memory-mappable) at any checkpoint, not just at the end of the run.
+    An int8 quantizer is saved next to the file unless save_quantizer is False, as for the
+    shards of a ShardedWriter, which saves the one they share itself.
+    """
+    def __init__(self, path, dim, resume_state=None, dtype='float32', metadata_columns=None, quantizer=None,
+                 timer=None, save_quantizer=True):
+        self.path = path
+        self.metadata_path = path + NPY_METADATA_SUFFIX
+        self.paths = [path, self.metadata_path]
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.metadata_columns = metadata_columns
+        self.quantizer = quantizer
+        self.timer = timer
+        if self.dtype == np.int8:
+            if quantizer is None:
+                raise ValueError("int8 output needs a fitted ScalarQuantizer")
+            if save_quantizer:
+                if resume_state is None:
+                    quantizer.save(path + QUANTIZATION_SUFFIX)
+                self.paths.append(path + QUANTIZATION_SUFFIX)
+
+        if resume_state is not None:
+            if resume_state.get('vector_dtype') != self.dtype.name:
+                raise RuntimeError(f"Checkpoint was written with {resume_state.get('vector_dtype')} "
+                                   f"vectors, not {self.dtype.name}; cannot resume")
+            self.count = resume_state['vectors_written']
+            truncate_to(path, NPY_HEADER_SIZE + self.count * dim * self.dtype.itemsize)
+            truncate_to(self.metadata_path, resume_state['metadata_offset'])
+            self.file = open(path, 'r+b')
+            self.file.seek(0, os.SEEK_END)
+            self.metadata_file = open(self.metadata_path, 'a', encoding='utf-8')
+        else:
+            self.count = 0
+            self.file = open(path, 'w+b')
+            self.file.write(npy_header(self.dtype, 0, dim))
+            self.metadata_file = open(self.metadata_path, 'w', encoding='utf-8')
+
+    def write(self, rows, embeddings, row_numbers=None, columns=None):
+        with timed(self.timer, 'serialize'):
+            if self.quantizer is not None:
+                vectors = self.quantizer.quantize(embeddings)
+            else:
+                vectors = np.ascontiguousarray(embeddings, dtype=self.dtype)
+            if vectors.shape != (len(rows), self.dim):
+                raise ValueError(f"Expected embeddings of shape {(len(rows), self.dim)}, got {vectors.shape}")
+
+            lines = []
+            for i, row in enumerate(as_records(rows, columns)):
+                if self.metadata_columns is not None:
+                    row = {column: row.get(column) for column in self.metadata_columns}
+                if row_numbers is not None:
+                    row = {'row': row_numbers[i], **row}
+                lines.append(json.dumps(row))
+
+        with timed(self.timer, 'disk_write'):
+            self.file.write(vectors.tobytes())
+            self.metadata_file.write('\n'.join(lines) + '\n')
+        self.count += len(rows)
+
+    def state(self):
+        end = self.file.tell()
+        self.file.seek(0)
+        self.file.write(npy_header(self.dtype, self.count, self.dim))
+        self.file.seek(end)
+        self.file.flush()
+        self.metadata_file.flush()
+        return {
+            'vectors_written': self.count,
+            'vector_dtype': self.dtype.name,
+            'metadata_offset': self.metadata_file.tell(),
+        }
+
+    def close(self):
+        self.state()
+        self.file.close()
+        self.metadata_file.close()
+
+    def abort(self):
+        self.close()
+
+
+def shard_path(path, index):
+    """
+    posts_with_vectors.jsonl -> posts_with_vectors-00003.jsonl
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}-{index:05d}{ext}'
+
+
+def manifest_path(path):
+    root, _ = os.path.splitext(path)
+    return root + '.manifest.json'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ShardedWriter:
+    """
+    Splits the output across numbered shard files, each written by its own inner writer.
+
+    With shard_size, shards are filled one after another and rolled over after exactly
+    shard_size rows, so each covers a contiguous run of the input. With num_shards, batches
+    are dealt round-robin across that many shards, which all stay open until the end.
+
+    Whenever a shard is finished, <output>.manifest.json is rewritten with its path, row count,
+    size, SHA-256 and first/last id, so finished shards can be picked up before the run ends.
+
+    With int8 vectors, the quantizer every shard shares is also saved once at
+    <output>.quant.json and listed in the manifest, which is where a resumed run reloads it from.
+    """
+    def __init__(self, path, open_shard, shard_size=None, num_shards=None, resume_state=None,
+                 id_column='tweet_id', manifest_info=None, quantizer=None):
+        if (shard_size is None) == (num_shards is None):
+            raise ValueError("Pass exactly one of shard_size and num_shards")
+        self.path = path
+        self.manifest_path = manifest_path(path)
+        self.open_shard = open_shard
+        self.shard_size = shard_size
+        self.num_shards = num_shards
+        self.id_column = id_column
+        self.manifest_info = dict(manifest_info or {})
+        self.writers = {} # shard index -> inner writer, for shards still being written
+        if quantizer is not None:
+            quantization_path = path + QUANTIZATION_SUFFIX
+            if resume_state is None:
+                quantizer.save(quantization_path)
+            self.manifest_info['quantization'] = quantization_path
+
+        if resume_state is not None:
+            if resume_state.get('shard_size') != shard_size or resume_state.get('num_shards') != num_shards:
+                raise RuntimeError("Checkpoint was written with a different shard layout; cannot resume")
+            self.shards = [dict(entry) for entry in resume_state['shards']]
+            self.batches_written = resume_state['batches_written']
+            for entry in self.shards:
+                if not entry['complete']:
+                    self.writers[entry['index']] = open_shard(entry['path'], entry.pop('state'))
+        else:
+            self.shards = []
+            self.batches_written = 0
+            if num_shards is not None:
+                for index in range(num_shards):
+                    self._start_shard(index)
+        self._write_manifest(complete=False)
+
+    @property
+    def paths(self):
+        """
+        Every file of the output: the shards' files, the manifest and the shared quantizer.
+        """
+        paths = [file['path'] for entry in self.shards for file in entry.get('files', [])]
+        paths += [path for writer in self.writers.values() for path in writer.paths]
+        paths.append(self.manifest_path)
+        if 'quantization' in self.manifest_info:
+            paths.append(self.manifest_info['quantization'])
+        return paths
+
+    def _start_shard(self, index):
+        entry = {
+            'index': index,
+            'path': shard_path(self.path, index),
+            'rows': 0,
+            'first_id': None,
+            'last_id': None,
+            'complete': False,
+        }
+        self.shards.append(entry)
+        self.writers[index] = self.open_shard(entry['path'], None)
+        return entry
+
+    def _finish_shard(self, entry):
+        writer = self.writers.pop(entry['index'])
+        writer.close()
+        entry['complete'] = True
+        entry['files'] = [
+            {'path': path, 'bytes': os.path.getsize(path), 'sha256': file_sha256(path)}
+            for path in writer.paths
+        ]
+        entry['bytes'] = entry['files'][0]['bytes']
+        entry['sha256'] = entry['files'][0]['sha256']
+        print(f"Finished shard {entry['path']}: {entry['rows']} rows, {entry['bytes'] / 1e6:.1f} MB")
+
+    def _append(self, entry, rows, embeddings, row_numbers, columns):
+        self.writers[entry['index']].write(rows, embeddings, row_numbers, columns)
+        first, last = next(as_records(rows[:1], columns)), next(as_records(rows[-1:], columns))
+        if entry['first_id'] is None:
+            entry['first_id'] = first.get(self.id_column)
+        entry['last_id'] = last.get(self.id_column)
+        entry['rows'] += len(rows)
+
+    def write(self, rows, embeddings, row_numbers=None, columns=None):
+        if self.num_shards is not None:
+            entry = self.shards[self.batches_written % self.num_shards]
+            self._append(entry, rows, embeddings, row_numbers, columns)
+        else:
+            start = 0
+            while start < len(rows):
+                entry = self.shards[-1] if self.shards and not self.shards[-1]['complete'] else None
+                if entry is None:
+                    entry = self._start_shard(len(self.shards))
+                end = min(len(rows), start + self.shard_size - entry['rows'])
+                self._append(entry, rows[start:end], embeddings[start:end],
+                             row_numbers[start:end] if row_numbers is not None else None, columns)
+                start = end
+                if entry['rows'] >= self.shard_size:
+                    self._finish_shard(entry)
+                    self._write_manifest(complete=False)
+        self.batches_written += 1
+
+    def state(self):
+        shards = []
+        for entry in self.shards:
+            entry = dict(entry)
+            if not entry['complete']:
+                entry['state'] = self.writers[entry['index']].state()
+            shards.append(entry)
+        return {
+            'shard_size': self.shard_size,
+            'num_shards': self.num_shards,
+            'batches_written': self.batches_written,
+            'shards': shards,
+        }
+
+    def _write_manifest(self, complete):
+        manifest = {
+            **self.manifest_info,
+            'complete': complete,
+            'total_rows': sum(entry['rows'] for entry in self.shards if entry['complete']),
+            'shards': [
+                {key: value for key, value in entry.items() if key != 'complete'}
+                for entry in self.shards if entry['complete']
+            ],
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def close(self):
+        for entry in self.shards:
+            if not entry['complete']:
+                if entry['rows'] == 0:
+                    # A round-robin shard that never got a batch
+                    writer = self.writers.pop(entry['index'])
+                    writer.close()
+                    for path in writer.paths:
+                        os.remove(path)
+                    entry['empty'] = True
+                else:
+                    self._finish_shard(entry)
+        self.shards = [entry for entry in self.shards if not entry.get('empty')]
+        self._write_manifest(complete=True)
+
+    def abort(self):
+        """
+        Closes the open shards after a failure without finishing them, so the manifest keeps
+        listing only shards that are known to be complete.
+        """
+        for writer in self.writers.values():
+            writer.abort()
+        self.writers = {}